@@ -0,0 +1,103 @@
+import json
+import os
+import threading
+import time
+
+import boto3
+
+from log import log
+
+
+class Checkpoint:
+    """
+    Traversal cursor of a full scan that ran out of time: the directories not listed yet,
+    the files not scanned yet and the id of the run they belong to. Written atomically
+    next to the manifest so a half written file never loses the cursor.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            log(f"Ignoring unreadable checkpoint {self.path}: {e}")
+            return None
+
+    def save(self, state):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class LambdaInvoker:
+    """
+    Resumes the scan in a fresh asynchronous invocation of the function.
+    """
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.client = boto3.client('lambda')
+
+    def invoke(self, event):
+        self.client.invoke(FunctionName=self.function_name, InvocationType='Event', Payload=json.dumps(event))
+
+
+class LocalContext:
+    """
+    Lambda context of a local run, with a time budget of its own like a fresh invocation.
+    """
+
+    def __init__(self, seconds):
+        self.deadline = time.monotonic() + seconds
+        self.invoked_function_arn = "local"
+        self.function_name = "local"
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+class LocalInvoker:
+    """
+    Stand-in for tests and local runs, resumes the scan on a thread of this process
+    with a fresh time budget of seconds.
+    """
+
+    def __init__(self, handler, seconds=900):
+        self.handler = handler
+        self.seconds = seconds
+        self.threads = []
+
+    def invoke(self, event):
+        thread = threading.Thread(target=self.handler, args=(event, LocalContext(self.seconds)))
+        thread.start()
+        self.threads.append(thread)
+
+
+class NoInvoker:
+    """
+    Leaves the checkpoint for the next scheduled run to pick up.
+    """
+
+    def invoke(self, event):
+        pass
+
+
+def make_invoker(kind, handler, context):
+    if kind == "lambda":
+        return LambdaInvoker(context.invoked_function_arn)
+    if kind == "local":
+        return LocalInvoker(handler)
+    return NoInvoker()
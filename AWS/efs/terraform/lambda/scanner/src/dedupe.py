@@ -0,0 +1,85 @@
+import hashlib
+import threading
+
+from log import log
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.digest()
+
+
+class _Content:
+    def __init__(self, path, digest=None):
+        self.path = path
+        self.digest = digest
+        self.result = None
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        return self.result
+
+
+class ContentIndex:
+    """
+    Finds files of a run with the same content as one scanned before them, so every content is
+    scanned once and its result handed to all of its paths. Files are bucketed by size first:
+    the first file of a size is scanned without reading it twice, files are only hashed once a
+    second file of the same size turns up. At most max_entries contents are remembered,
+    files past that are scanned as usual.
+    """
+
+    def __init__(self, min_size=0, max_entries=50000):
+        self.min_size = min_size
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.sizes = {}
+        self.digests = {}
+
+    def claim(self, path, st):
+        """
+        Returns (entry, None) when the file is to be scanned and its result passed to resolve(entry, result),
+        (None, original) when it has the content of a file whose result original.wait() returns,
+        or (None, None) when it is scanned without being remembered.
+        """
+        size = st.st_size
+        if size < self.min_size:
+            return None, None
+        with self.lock:
+            first = self.sizes.get(size)
+            if first is None:
+                if len(self.sizes) >= self.max_entries:
+                    return None, None
+                entry = self.sizes[size] = _Content(path)
+                return entry, None
+        try:
+            digest = _digest(path)
+            first_digest = first.digest or _digest(first.path)
+        except OSError as e:
+            log(e)
+            return None, None
+        with self.lock:
+            if first.digest is None:
+                first.digest = first_digest
+                self.digests.setdefault(first_digest, first)
+            original = self.digests.get(digest)
+            if original is not None:
+                return None, original
+            if len(self.digests) >= self.max_entries:
+                return None, None
+            entry = self.digests[digest] = _Content(path, digest)
+            return entry, None
+
+    def resolve(self, entry, result):
+        """
+        Hands the result of a claimed file to the files waiting on its content, None when
+        the scan failed and they have to be scanned themselves.
+        """
+        entry.result = result
+        entry.done.set()
@@ -0,0 +1,435 @@
+import heapq
+import itertools
+import math
+import os
+import queue
+import threading
+import time
+
+from log import log
+
+# tells a worker that there is no more work
+_DONE = None
+
+
+class ScanEngine:
+    """
+    Walks directory trees with several os.scandir workers and scans the files they find
+    on a pool of scan workers. Files go through a bounded queue, so the walk never runs
+    far ahead of the scans and memory stays flat however large the tree is.
+
+    A failed scan never stops the others. When retryable(error) says it may succeed
+    later, the file is scanned again up to retries times, backing off from
+    backoff_seconds, while the rest of the run goes on.
+
+    When the files are scanned in priority order, the queue holds up to lookahead
+    files instead of queue_size, so the walk can get that far ahead of the scans.
+    """
+
+    def __init__(self, scan, walkers=4, workers=8, queue_size=1000, retries=0, backoff_seconds=1.0, retryable=None,
+                 lookahead=None):
+        self.scan = scan
+        self.walkers = walkers
+        self.workers = workers
+        self.queue_size = queue_size
+        self.lookahead = lookahead or queue_size
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.retryable = retryable
+
+    def run(self, roots, select=None, handle=None, skip_dir=None, files=None, should_stop=None, shallow_roots=None,
+            dedupe=None, priority=None, fail=None, abandon=None, link=None, partial_dirs=None):
+        """
+        select(path, st) decides whether a file found by the walk is scanned,
+        handle(path, st, result) receives the result of every scan,
+        fail(path, error, retryable) every file given up on and
+        skip_dir(path) prunes directories from the walk. files are scanned
+        along with whatever the walk finds, and so are the files directly in
+        shallow_roots, without descending into their subdirectories. partial_dirs
+        are [path, recursive, names] of directories an earlier run listed in part,
+        they are listed again without the entries in names.
+
+        Hardlinks of a file selected earlier in the run are skipped and passed to
+        link(path, st), a link select turned down never stands for the others. With a dedupe
+        ContentIndex, files with the same content as one scanned earlier are not
+        scanned again, handle receives the result of the earlier file for them.
+
+        With priority(path, st), the files waiting for a scan worker are scanned
+        highest priority first instead of in the order the walk found them. Up to
+        lookahead files found but not scanned yet are ordered, so memory stays bounded:
+        in a tree of more files a file deep in the walk is still found, and scanned,
+        after the walk has had that many files ahead of it.
+
+        Once should_stop() returns True no new directory is listed and no new scan
+        is started, the scans in flight finish and files waiting for a retry are left
+        to do. Returns the number of files found by the walk, skipped, linked, scanned,
+        deduplicated, retried and failed, and the directories and files left to do, which
+        resume the run when passed back as roots, shallow_roots, partial_dirs and files.
+
+        Once abandon() also returns True the run stops waiting for the scans in flight,
+        their files and the directories being listed are left to do and their results
+        are dropped, so a slow scan never holds up saving where the run got to.
+        """
+        run = _Run(self, select, handle, skip_dir, should_stop, dedupe, priority, fail, abandon, link)
+        return run.start(roots, shallow_roots or [], partial_dirs or [], files or [])
+
+
+class _Run:
+    def __init__(self, engine, select, handle, skip_dir, should_stop, dedupe, priority, fail, abandon, link):
+        self.engine = engine
+        self.select = select
+        self.handle = handle
+        self.skip_dir = skip_dir
+        self.should_stop = should_stop
+        self.dedupe = dedupe
+        self.priority = priority
+        self.fail = fail
+        self.abandon = abandon
+        self.link = link
+        self.dirs = queue.Queue()
+        if priority is None:
+            self.files = queue.Queue(engine.queue_size)
+        else:
+            # a bounded heap of (-priority, order found, path, st, attempt),
+            # the order keeps equal priorities first in first out
+            self.files = queue.PriorityQueue(engine.lookahead)
+            self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.counts = {"found": 0, "skipped": 0, "linked": 0, "scanned": 0, "duplicates": 0, "retried": 0,
+                       "failed": 0}
+        # (st_dev, st_ino) of the files selected with more than one link
+        self.links = set()
+        self.pending = {"dirs": [], "shallow_dirs": [], "partial_dirs": [], "files": []}
+        self.outstanding = 0
+        self.stopped = False
+        self.abandoned = False
+        # files being scanned, and the entries handed on so far of each directory being listed,
+        # left to do when the run is abandoned
+        self.in_flight = set()
+        self.listing = {}
+        # files waiting for another attempt, a heap of (due, order, path, st, attempt),
+        # and the number of files queued, being scanned or waiting for another attempt
+        self.retry_cond = threading.Condition()
+        self.delayed = []
+        self.delay_order = itertools.count()
+        self.unfinished = 0
+        self.closed = False
+
+    def start(self, roots, shallow_roots, partial_dirs, files):
+        for root in roots:
+            self.add_dir(root)
+        for root in shallow_roots:
+            self.add_dir(root, recursive=False)
+        for root, recursive, names in partial_dirs:
+            self.add_dir(root, recursive, frozenset(names))
+        if not roots and not shallow_roots and not partial_dirs:
+            for _ in range(self.engine.walkers):
+                self.dirs.put(_DONE)
+
+        walk_threads = [threading.Thread(target=self.walk, daemon=True) for _ in range(self.engine.walkers)]
+        work_threads = [threading.Thread(target=self.work, daemon=True) for _ in range(self.engine.workers)]
+        retry_thread = threading.Thread(target=self.requeue, daemon=True)
+        for thread in walk_threads + work_threads + [retry_thread]:
+            thread.start()
+        for path in files:
+            self.add_file(path)
+        for thread in walk_threads:
+            while thread.is_alive() and not self.abandoning():
+                thread.join(1)
+                self.drain()
+        with self.retry_cond:
+            while self.unfinished and not self.abandoning():
+                self.retry_cond.wait(1)
+                self.drain()
+            self.closed = True
+            self.retry_cond.notify_all()
+
+        if self.abandoned:
+            # the retry thread may have been putting a file back in the queue
+            self.drain()
+            retry_thread.join(1)
+            self.drain()
+            self.leave_delayed()
+            self.leave_queued_dirs()
+            with self.lock:
+                log(f"Gave up waiting for {len(self.in_flight)} scans in flight")
+                self.pending["files"].extend(self.in_flight)
+                # entries of the directories being listed that are already left to do on their own,
+                # also when the walker did not get to recording them as handed on
+                left = [path for key in ("dirs", "shallow_dirs", "files") for path in self.pending[key]]
+                left += [item[0] for item in self.pending["partial_dirs"]] + [path for path, _ in self.listing]
+                carried = {}
+                for path in left:
+                    carried.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+                for (path, recursive), names in self.listing.items():
+                    names = set(names) | carried.get(path, set())
+                    self.pending["partial_dirs"].append([path, recursive, sorted(names)])
+                # workers and walkers still running must not change what is returned
+                counts = dict(self.counts)
+                pending = {key: list(value) for key, value in self.pending.items()}
+            for _ in work_threads:
+                try:
+                    self.put_file(_DONE, block=False)
+                except queue.Full:
+                    break
+            return counts, pending
+
+        retry_thread.join()
+        for _ in work_threads:
+            self.put_file(_DONE)
+        for thread in work_threads:
+            thread.join()
+        return self.counts, self.pending
+
+    def stopping(self):
+        if not self.stopped and self.should_stop is not None and self.should_stop():
+            self.stopped = True
+        return self.stopped
+
+    def abandoning(self):
+        if not self.abandoned and self.stopping() and self.abandon is not None and self.abandon():
+            with self.lock:
+                self.abandoned = True
+        return self.abandoned
+
+    def drain(self):
+        """
+        Once the run stops, files still queued are left to do right away, so walkers blocked
+        on the full queue get on even when every worker is busy with a long scan.
+        """
+        if not self.stopping():
+            return
+        while True:
+            try:
+                path, st, attempt = self.get_file(block=False)
+            except queue.Empty:
+                return
+            with self.lock:
+                self.pending["files"].append(path)
+            with self.retry_cond:
+                self.unfinished -= 1
+                self.retry_cond.notify_all()
+
+    def leave_delayed(self):
+        with self.retry_cond:
+            if self.delayed:
+                with self.lock:
+                    self.pending["files"].extend(item[2] for item in self.delayed)
+                self.unfinished -= len(self.delayed)
+                self.delayed = []
+                self.retry_cond.notify_all()
+
+    def leave_queued_dirs(self):
+        while True:
+            try:
+                item = self.dirs.get(block=False)
+            except queue.Empty:
+                break
+            if item is not _DONE:
+                self.leave_dir(*item)
+        # idle walkers are done
+        for _ in range(self.engine.walkers):
+            self.dirs.put(_DONE)
+
+    def add_dir(self, path, recursive=True, skip=frozenset()):
+        with self.lock:
+            self.outstanding += 1
+        self.dirs.put((path, recursive, skip))
+
+    def leave_dir(self, path, recursive, skip):
+        with self.lock:
+            if skip:
+                self.pending["partial_dirs"].append([path, recursive, sorted(skip)])
+            else:
+                self.pending["dirs" if recursive else "shallow_dirs"].append(path)
+
+    def add_file(self, path, st=None):
+        # files passed to run() were found by an earlier slice or named by the caller
+        walked = st is not None
+        if self.stopping():
+            with self.lock:
+                if walked:
+                    self.counts["found"] += 1
+                self.pending["files"].append(path)
+            return
+        if st is None:
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                log(e)
+                with self.lock:
+                    self.counts["failed"] += 1
+                if self.fail is not None:
+                    self.fail(path, e, False)
+                return
+        selected = self.select is None or self.select(path, st)
+        linked = False
+        with self.lock:
+            if walked:
+                self.counts["found"] += 1
+            if not selected:
+                self.counts["skipped"] += 1
+            elif st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                linked = key in self.links
+                self.links.add(key)
+                if linked:
+                    self.counts["linked"] += 1
+        if linked:
+            if self.link is not None:
+                self.link(path, st)
+        elif selected:
+            with self.retry_cond:
+                self.unfinished += 1
+            self.put_file((path, st, 0))
+
+    def put_file(self, item, block=True):
+        if self.priority is None:
+            self.files.put(item, block)
+        elif item is _DONE:
+            # after every file still queued
+            self.files.put((math.inf, next(self.order), None, None, 0), block)
+        else:
+            path, st, attempt = item
+            self.files.put((-self.priority(path, st), next(self.order), path, st, attempt), block)
+
+    def get_file(self, block=True):
+        item = self.files.get(block)
+        if self.priority is None:
+            return item
+        _, _, path, st, attempt = item
+        return _DONE if path is None else (path, st, attempt)
+
+    def walk(self):
+        while True:
+            item = self.dirs.get()
+            if item is _DONE:
+                return
+            path, recursive, skip = item
+            try:
+                if self.stopping():
+                    self.leave_dir(path, recursive, skip)
+                else:
+                    names = list(skip)
+                    with self.lock:
+                        self.listing[path, recursive] = names
+                    try:
+                        self.list_dir(path, recursive, names, skip)
+                    finally:
+                        with self.lock:
+                            del self.listing[path, recursive]
+            finally:
+                with self.lock:
+                    self.outstanding -= 1
+                    finished = self.outstanding == 0
+                if finished:
+                    for _ in range(self.engine.walkers):
+                        self.dirs.put(_DONE)
+
+    def list_dir(self, path, recursive, names, skip):
+        try:
+            entries = os.scandir(path)
+        except OSError as e:
+            log(e)
+            return
+        with entries:
+            for entry in entries:
+                if entry.name in skip:
+                    continue
+                self.list_entry(entry, recursive)
+                # only once handed on, so a directory listed in part is listed again without it
+                names.append(entry.name)
+
+    def list_entry(self, entry, recursive):
+        try:
+            if entry.is_dir():
+                # like os.walk, symlinks to directories are not followed
+                if recursive and not entry.is_symlink() and \
+                        (self.skip_dir is None or not self.skip_dir(entry.path)):
+                    self.add_dir(entry.path)
+                return
+            st = entry.stat()
+        except OSError as e:
+            log(e)
+            return
+        self.add_file(entry.path, st)
+
+    def work(self):
+        while True:
+            item = self.get_file()
+            if item is _DONE:
+                return
+            path, st, attempt = item
+            key = None
+            if self.stopping():
+                with self.lock:
+                    self.pending["files"].append(path)
+            else:
+                with self.lock:
+                    self.in_flight.add(path)
+                try:
+                    result, key = self.scan(path, st)
+                    if self.handle is not None and not self.abandoned:
+                        self.handle(path, st, result)
+                except Exception as e:
+                    key = None if self.abandoned else self.failed(path, st, attempt, e)
+                with self.lock:
+                    self.in_flight.discard(path)
+                    if self.abandoned:
+                        # the file was handed back as left to do
+                        return
+                    self.counts[key] += 1
+            if key != "retried":
+                with self.retry_cond:
+                    self.unfinished -= 1
+                    if not self.unfinished:
+                        self.retry_cond.notify_all()
+
+    def failed(self, path, st, attempt, error):
+        retryable = self.engine.retryable is not None and self.engine.retryable(error)
+        if retryable and attempt < self.engine.retries:
+            log(f"Failed to scan {path}, retrying: {error}")
+            due = time.monotonic() + self.engine.backoff_seconds * 2 ** attempt
+            with self.retry_cond:
+                heapq.heappush(self.delayed, (due, next(self.delay_order), path, st, attempt + 1))
+                self.retry_cond.notify_all()
+            return "retried"
+        log(f"Failed to scan {path}: {error}")
+        if self.fail is not None:
+            self.fail(path, error, retryable)
+        return "failed"
+
+    def requeue(self):
+        """
+        Puts files back in the queue once their backoff is over, or leaves them to do when the run stops.
+        """
+        while True:
+            with self.retry_cond:
+                while True:
+                    if self.delayed and self.stopping():
+                        self.leave_delayed()
+                    if self.closed:
+                        return
+                    if self.delayed and self.delayed[0][0] <= time.monotonic():
+                        _, _, path, st, attempt = heapq.heappop(self.delayed)
+                        break
+                    # wake up now and then to notice the run stopping
+                    timeout = self.delayed[0][0] - time.monotonic() if self.delayed else 1
+                    self.retry_cond.wait(min(timeout, 1))
+            self.put_file((path, st, attempt))
+
+    def scan(self, path, st):
+        if self.dedupe is None:
+            return self.engine.scan(path), "scanned"
+        entry, original = self.dedupe.claim(path, st)
+        if original is not None:
+            result = original.wait()
+            if result is not None:
+                return result, "duplicates"
+        result = None
+        try:
+            result = self.engine.scan(path)
+            return result, "scanned"
+        finally:
+            if entry is not None:
+                self.dedupe.resolve(entry, result)
@@ -0,0 +1,31 @@
+import errno
+
+# the file is gone or can never be read, scanning it again will not help
+PERMANENT_ERRNOS = {errno.ENOENT, errno.EACCES, errno.EPERM, errno.EISDIR, errno.ENOTDIR, errno.ELOOP,
+                    errno.ENAMETOOLONG}
+# SDK errors about the file or the API key rather than the service
+PERMANENT_SDK_ERRORS = {"MSG_ID_ERR_FILE_NOT_FOUND", "MSG_ID_ERR_FILE_NO_PERMISSION", "MSG_ID_ERR_KEY_AUTH_FAILED",
+                        "MSG_ID_ERR_MISSING_AUTH", "MSG_ID_ERR_INVALID_REGION", "MSG_ID_ERR_INVALID_TAG",
+                        "MSG_ID_ERR_TAG_NUMBER_EXCEED"}
+# gRPC status codes a later attempt can get past: DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED,
+# INTERNAL and UNAVAILABLE
+RETRYABLE_GRPC_CODES = {4, 8, 10, 13, 14}
+
+
+def is_retryable(error):
+    """
+    Whether a failed scan is worth another attempt: NFS hiccups, rate limiting and an unavailable
+    service are, a missing or unreadable file, a rejected API key or a malformed result are not.
+    """
+    if isinstance(error, OSError):
+        return error.errno not in PERMANENT_ERRNOS
+    if isinstance(error, (ValueError, TypeError)):
+        return False
+    # the SDK wraps every error in an AMaasException with an error_code enum
+    code = getattr(error, 'error_code', None)
+    if code is not None:
+        if code.name == "MSG_ID_GRPC_ERROR":
+            params = getattr(error, 'params', ())
+            return bool(params) and params[0] in RETRYABLE_GRPC_CODES
+        return code.name not in PERMANENT_SDK_ERRORS
+    return True
@@ -0,0 +1,16 @@
+import sys
+import threading
+
+_lock = threading.Lock()
+
+
+def log(message):
+    """
+    Writes one line to the function log. print() writes the text and the newline separately,
+    so lines of the walk, scan and publisher threads ran into each other, here every line is
+    formatted first and written in one call.
+    """
+    line = f"{message}\n"
+    with _lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
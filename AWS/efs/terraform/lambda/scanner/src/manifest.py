@@ -0,0 +1,141 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+# pending writes are committed in batches, one transaction per file would dominate small-file scans
+COMMIT_EVERY = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT,
+    verdict INTEGER,
+    scanned_at REAL NOT NULL,
+    seen_run TEXT
+)
+"""
+
+
+class Manifest:
+    """
+    Record of every scanned file: path, inode, size, mtime_ns, sha256 and last verdict.
+    SQLite does not lock reliably over NFS, so the database is copied from the EFS mount
+    to local storage when opened and written back atomically by save().
+    """
+
+    def __init__(self, path, max_age_seconds=0, work_dir="/tmp", run_id=None):
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        self.local_path = os.path.join(work_dir, f"manifest-{os.getpid()}-{time.time_ns()}.db")
+        if os.path.exists(path):
+            shutil.copyfile(path, self.local_path)
+        elif os.path.exists(self.local_path):
+            os.remove(self.local_path)
+        self.db = sqlite3.connect(self.local_path, check_same_thread=False)
+        self.db.execute(SCHEMA)
+        # a run resumed from a checkpoint keeps its id, so prune() sees the files of every slice
+        self.run_id = run_id or str(time.time_ns())
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def needs_scan(self, path, st):
+        """
+        True when the file is new, changed since its last scan or its verdict is too old.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT inode, size, mtime_ns, scanned_at FROM files WHERE path = ?",
+                                  (path,)).fetchone()
+            if row is None:
+                return True
+            inode, size, mtime_ns, scanned_at = row
+            if (inode, size, mtime_ns) != (st.st_ino, st.st_size, st.st_mtime_ns):
+                return True
+            if self.max_age_seconds and time.time() - scanned_at > self.max_age_seconds:
+                return True
+            self.db.execute("UPDATE files SET seen_run = ? WHERE path = ?", (self.run_id, path))
+            self._written()
+            return False
+
+    def record(self, path, st, sha256, verdict):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (path, st.st_ino, st.st_size, st.st_mtime_ns, sha256, verdict, time.time(),
+                             self.run_id))
+            self._written()
+
+    def record_link(self, path, st):
+        """
+        Record a hardlink that was not scanned because another link to the file was, so the
+        next run finds it unchanged and prune() keeps it. The verdict is on the scanned link.
+        """
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, NULL, NULL, ?, ?)",
+                            (path, st.st_ino, st.st_size, st.st_mtime_ns, time.time(), self.run_id))
+            self._written()
+
+    def prune(self, run_id=None):
+        """
+        Forget files not seen by this run, or by run_id, only call it after a walk of the whole tree.
+        """
+        with self.lock:
+            removed = self.db.execute("DELETE FROM files WHERE seen_run IS NOT ?", (run_id or self.run_id,)).rowcount
+            self._written()
+            return removed
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= COMMIT_EVERY:
+            self.db.commit()
+            self.pending = 0
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+            backup = sqlite3.connect(tmp_path)
+            try:
+                self.db.backup(backup)
+            finally:
+                backup.close()
+        os.replace(tmp_path, self.path)
+
+    def save_delta(self, path):
+        """
+        Write only the files this run has seen, for a coordinator to merge() into the manifest.
+        Shard workers use it instead of save() so they never overwrite each other.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        delta = sqlite3.connect(tmp_path)
+        try:
+            delta.execute(SCHEMA)
+            with self.lock:
+                rows = self.db.execute("SELECT * FROM files WHERE seen_run = ?", (self.run_id,)).fetchall()
+            delta.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            delta.commit()
+        finally:
+            delta.close()
+        os.replace(tmp_path, path)
+
+    def merge(self, path):
+        with self.lock:
+            self.db.execute("ATTACH DATABASE ? AS delta", (path,))
+            try:
+                self.db.execute("INSERT OR REPLACE INTO files SELECT * FROM delta.files")
+                self.db.commit()
+            finally:
+                self.db.execute("DETACH DATABASE delta")
+
+    def close(self):
+        self.db.close()
+        if os.path.exists(self.local_path):
+            os.remove(self.local_path)
@@ -0,0 +1,46 @@
+import os
+import time
+
+# extensions malware is usually delivered as, and how much they add to the risk score
+RISKY_EXTENSIONS = {
+    ".exe": 5, ".dll": 5, ".scr": 5, ".com": 5, ".msi": 5, ".sys": 4, ".elf": 4, ".so": 3,
+    ".js": 4, ".vbs": 4, ".ps1": 4, ".bat": 4, ".cmd": 4, ".hta": 4, ".jar": 4, ".lnk": 4,
+    ".sh": 3, ".py": 2, ".php": 3, ".jsp": 3, ".asp": 3, ".aspx": 3,
+    ".docm": 4, ".xlsm": 4, ".pptm": 4, ".doc": 3, ".xls": 3, ".rtf": 3, ".pdf": 2,
+    ".zip": 3, ".rar": 3, ".7z": 3, ".gz": 2, ".tar": 2, ".iso": 3, ".img": 3,
+}
+# directories files are dropped into from outside
+RISKY_DIRS = {"tmp", "temp", "upload", "uploads", "incoming", "download", "downloads", "public", "shared", "www"}
+# most executables and droppers are smaller than this
+SMALL_FILE_SIZE = 10 * 1024 * 1024
+RECENT_SECONDS = 24 * 3600
+
+
+def newest_first(path, st):
+    return st.st_mtime_ns
+
+
+def risk_score(path, st):
+    """
+    Rough likelihood that a file matters: what its extension is, where it lives,
+    how large it is and whether it changed in the last day.
+    """
+    score = RISKY_EXTENSIONS.get(os.path.splitext(path)[1].lower(), 0)
+    parts = path.lower().split("/")[:-1]
+    if any(part in RISKY_DIRS for part in parts):
+        score += 2
+    if any(part.startswith(".") for part in parts):
+        score += 1
+    if 0 < st.st_size <= SMALL_FILE_SIZE:
+        score += 1
+    if time.time() - st.st_mtime < RECENT_SECONDS:
+        score += 2
+    return score
+
+
+def make_priority(kind):
+    if kind == "newest":
+        return newest_first
+    if kind == "risk":
+        return risk_score
+    return None
@@ -0,0 +1,105 @@
+import collections
+import threading
+import time
+
+from log import log
+
+# SNS PublishBatch limits: 10 entries and 256 KiB of payload per call
+MAX_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+
+
+class BatchPublisher:
+    """
+    Publishes messages to an SNS topic with PublishBatch from a background thread, so scans never
+    wait on SNS. Messages are packed up to the entry and payload limits of a call, entries SNS
+    fails are retried with backoff. publish() blocks when max_queued messages are waiting.
+    """
+
+    def __init__(self, client, topic_arn, max_queued=1000, retries=3, backoff_seconds=0.5, linger_seconds=0.05):
+        self.client = client
+        self.topic_arn = topic_arn
+        self.max_queued = max_queued
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.linger_seconds = linger_seconds
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.published = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def publish(self, message):
+        with self.cond:
+            while len(self.queue) >= self.max_queued:
+                self.cond.wait()
+            self.queue.append((message, 0))
+            self.cond.notify_all()
+
+    def close(self):
+        """
+        Send everything still queued and stop the background thread.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def _next_batch(self):
+        with self.cond:
+            while not self.queue and not self.closed:
+                self.cond.wait()
+            if not self.queue:
+                return None
+            # give the scans a moment to fill the batch, every publish() wakes the wait up
+            deadline = time.monotonic() + self.linger_seconds
+            while len(self.queue) < MAX_ENTRIES and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            batch = []
+            size = 0
+            while self.queue and len(batch) < MAX_ENTRIES:
+                message, attempt = self.queue[0]
+                length = len(message.encode())
+                if batch and size + length > MAX_BATCH_BYTES:
+                    break
+                self.queue.popleft()
+                batch.append((message, attempt))
+                size += length
+            self.cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            entries = [{'Id': str(i), 'Message': message} for i, (message, _) in enumerate(batch)]
+            try:
+                response = self.client.publish_batch(TopicArn=self.topic_arn, PublishBatchRequestEntries=entries)
+                failed = [(int(f['Id']), f.get('Message', f.get('Code'))) for f in response.get('Failed', [])]
+            except Exception as e:
+                failed = [(i, str(e)) for i in range(len(batch))]
+            self.published += len(batch) - len(failed)
+            if failed:
+                self._retry(batch, failed)
+
+    def _retry(self, batch, failed):
+        retry = []
+        for i, reason in failed:
+            message, attempt = batch[i]
+            if attempt < self.retries:
+                retry.append((message, attempt + 1))
+            else:
+                log(f"Failed to publish result to SNS: {reason}")
+                self.failed += 1
+        if not retry:
+            return
+        time.sleep(self.backoff_seconds * 2 ** (retry[0][1] - 1))
+        with self.cond:
+            self.queue.extendleft(reversed(retry))
+            self.cond.notify_all()
@@ -3,6 +3,21 @@ import json
 import os
 import boto3
 import time
+import uuid
+
+from checkpoint import Checkpoint
+from checkpoint import NoInvoker
+from checkpoint import make_invoker
+from dedupe import ContentIndex
+from engine import ScanEngine
+from failures import is_retryable
+from log import log
+from manifest import Manifest
+from priority import make_priority
+from scope import make_scope
+from shards import make_executor
+from shards import plan_shards
+from sinks import make_sink
 
 v1_region = os.environ.get('v1_region')
 mount_dir = "/mnt/efs"
@@ -10,6 +25,44 @@ secret_manager = boto3.client('secretsmanager')
 sns = boto3.client('sns')
 topic_arn = os.environ['topic_arn']
 
+# Scanner state kept on the EFS mount, never scanned itself
+state_dir = os.environ.get('state_dir', f"{mount_dir}/.amaas")
+# Incremental full scans only scan files that are new, changed, or whose verdict is older than the max age
+incremental_scan = os.environ.get('incremental_scan', 'true').lower() == 'true'
+rescan_max_age_hours = float(os.environ.get('rescan_max_age_hours', 168))
+# Full scans walk the tree with several directory workers and scan on a pool of workers
+walk_workers = int(os.environ.get('walk_workers', 4))
+scan_workers = int(os.environ.get('scan_workers', 8))
+scan_queue_size = int(os.environ.get('scan_queue_size', 1000))
+# Full scans stop this many seconds before the Lambda timeout and save a checkpoint to resume from,
+# resumed by a new invocation of the function ("lambda"), in this process ("local") or by the next schedule ("none")
+checkpoint_margin_seconds = float(os.environ.get('checkpoint_margin_seconds', 10))
+resume_invoker = os.environ.get('resume_invoker', 'lambda')
+max_resume_invocations = int(os.environ.get('max_resume_invocations', 100))
+# Full scans are split into this many shards scanned by separate invocations of the function ("lambda"),
+# or by a local process pool ("local")
+scan_shards = int(os.environ.get('scan_shards', 1))
+shard_executor = os.environ.get('shard_executor', 'lambda')
+shard_dir = f"{state_dir}/shards"
+# Scan results are streamed to these sinks: "notifier" (SNS), "summary" (logged totals and detections)
+# and "jsonl" (a JSON-lines file in results_dir, /tmp or a directory on the EFS)
+result_sinks = os.environ.get('result_sinks', 'notifier,summary')
+results_dir = os.environ.get('results_dir', '/tmp')
+# Files with the same content as one scanned earlier in the invocation get its verdict instead of another scan,
+# only files of at least this size are compared
+content_dedupe = os.environ.get('content_dedupe', 'false').lower() == 'true'
+content_dedupe_min_size_kb = float(os.environ.get('content_dedupe_min_size_kb', 64))
+# Order files waiting for a scan worker are scanned in: as the walk finds them ("walk"),
+# most recently modified first ("newest") or highest risk score first ("risk"). Up to priority_lookahead files
+# found by the walk wait to be ordered, a tree of fewer files is scanned in order from start to end
+scan_order = os.environ.get('scan_order', 'walk')
+priority_lookahead = int(os.environ.get('priority_lookahead', 20000))
+# Files whose scan failed for a reason that may pass, like rate limiting or an NFS hiccup,
+# are scanned again up to this many times in the same invocation, backing off between attempts
+scan_retries = int(os.environ.get('scan_retries', 3))
+retry_backoff_seconds = float(os.environ.get('retry_backoff_seconds', 1))
+LAMBDA_MAX_SECONDS = 900
+
 def lambda_handler(event, context):
     # Manual scan status
     scan_type = event.get('scan_type')
@@ -32,61 +85,281 @@ def lambda_handler(event, context):
         size = os.path.getsize(file)
         return size
 
+    # errors are raised for the scan engine to retry or record the file
     def scan_file(file, init):
         s = time.perf_counter()
         size = calc_file_size(file)
-        try:
-            result = amaas.grpc.scan_file(file, init)
-            elapsed = time.perf_counter() - s
-        except Exception as e:
-            print(e)
-            return None
+        result = amaas.grpc.scan_file(init, file)
+        elapsed = time.perf_counter() - s
         result_json = json.loads(result)
         result_json['scanDuration'] = f"{elapsed:0.2f}s"
         result_json['size'] = size
         return json.dumps(result_json, indent=2)
         
+    def scan(file):
+        log(f"Processing Target: {file}")
+        return scan_file(file, init)
+
+    def report(file, result):
+        scan = json.loads(result)
+        # a result handed over from a file with the same content carries the name of that file
+        scan['fileName'] = os.path.basename(file)
+        log(f"Scan Result: {scan}")
+        sink.write(file, scan)
+        return scan
+
+    def make_engine():
+        # the scan workers share the gRPC channel
+        return ScanEngine(scan, walk_workers, scan_workers, scan_queue_size, scan_retries, retry_backoff_seconds,
+                          is_retryable, priority_lookahead)
+
+    def content_index():
+        if event.get('content_dedupe', content_dedupe):
+            return ContentIndex(content_dedupe_min_size_kb * 1024)
+        return None
+
+    def scan_tree(area, state, checkpoint, shard=None):
+        if state:
+            log(f"Full scan mode: resuming from checkpoint, slice {state['slice']}...")
+            roots, shallow_roots, files = state['dirs'], state.get('shallow_dirs', []), state['files']
+            partial_dirs = state.get('partial_dirs', [])
+            run_id, totals = state['run_id'], state.get('counts', {})
+        else:
+            log("Full scan mode: scanning all files...")
+            roots, shallow_roots, files = area['dirs'], area['shallow_dirs'], []
+            partial_dirs = []
+            run_id, totals = shard['run_id'] if shard else None, {}
+        manifest = None
+        if event.get('incremental', incremental_scan):
+            manifest = Manifest(f"{state_dir}/manifest.db", rescan_max_age_hours * 3600, run_id=run_id)
+
+        def select(file, st):
+            return scope.select(file, st) and (manifest is None or manifest.needs_scan(file, st))
+
+        def handle(file, st, result):
+            scan = report(file, result)
+            if manifest is not None:
+                manifest.record(file, st, scan.get('fileSHA256'), scan.get('scanResult'))
+
+        # stop starting scans early enough for the scans in flight to finish and the checkpoint to be written,
+        # and stop waiting for them halfway through the margin, slow ones are scanned again by the next slice
+        remaining = context.get_remaining_time_in_millis() / 1000
+        deadline = time.monotonic() + remaining - checkpoint_margin_seconds
+        give_up = time.monotonic() + remaining - checkpoint_margin_seconds / 2
+
+        engine = make_engine()
+        counts, pending = engine.run(roots, select, handle, skip_dir=skip_dir, files=files,
+                                     should_stop=lambda: time.monotonic() > deadline, shallow_roots=shallow_roots,
+                                     dedupe=content_index(), priority=make_priority(event.get('order', scan_order)),
+                                     fail=sink.write_failure, abandon=lambda: time.monotonic() > give_up,
+                                     link=manifest.record_link if manifest is not None else None,
+                                     partial_dirs=partial_dirs)
+        log(f"Full scan: {counts['found']} files found, {counts['scanned']} scanned, {counts['failed']} failed, "
+            f"{counts['linked'] + counts['duplicates']} duplicates")
+        totals = {key: totals.get(key, 0) + value for key, value in counts.items()}
+
+        slice_number = (state['slice'] if state else 0) + 1
+        done = not any(pending.values())
+        if manifest is not None:
+            if shard:
+                # shard workers never write the manifest itself, the coordinator merges their deltas
+                manifest.save_delta(f"{shard_dir}/{shard['run_id']}-{shard['id']}-{slice_number}.db")
+            else:
+                # deleted files can only be told apart once the walk of the whole tree is over
+                if done and scope.restricted:
+                    log(f"Incremental scan: {totals['skipped']} unchanged or excluded files skipped")
+                elif done:
+                    removed = manifest.prune()
+                    log(f"Incremental scan: {totals['skipped']} unchanged files skipped, "
+                        f"{removed} deleted files forgotten")
+                manifest.save()
+            manifest.close()
+        if done:
+            checkpoint.clear()
+            if shard:
+                report_shard(shard, totals)
+            return
+
+        kind = resume_invoker if slice_number < max_resume_invocations else "none"
+        invoker = make_invoker(kind, lambda_handler, context)
+        token = None if isinstance(invoker, NoInvoker) else uuid.uuid4().hex
+        checkpoint.save({
+            'dirs': pending['dirs'],
+            'shallow_dirs': pending['shallow_dirs'],
+            'partial_dirs': pending['partial_dirs'],
+            'files': pending['files'],
+            'run_id': manifest.run_id if manifest is not None else run_id,
+            'counts': totals,
+            'slice': slice_number,
+            'token': token,
+            'saved_at': time.time(),
+        })
+        directories = len(pending['dirs']) + len(pending['shallow_dirs']) + len(pending['partial_dirs'])
+        log(f"Out of time, checkpoint saved with {directories} directories and {len(pending['files'])} files left")
+        invoker.invoke(dict(event, resume=True, resume_token=token,
+                            incremental=event.get('incremental', incremental_scan)))
+
+    def report_shard(shard, totals):
+        with open(f"{shard_dir}/{shard['run_id']}-{shard['id']}.done.json", "w") as f:
+            json.dump(totals, f)
+
+    def collect_shards(manifest):
+        """
+        Merge what the shard workers of earlier runs recorded into the manifest, and
+        once every shard of a run has reported, aggregate their counts. Returns the run
+        still waiting on shards, a run whose unfinished shards all stopped is dropped.
+        """
+        os.makedirs(shard_dir, exist_ok=True)
+        run = Checkpoint(f"{shard_dir}/run.json").load()
+        for name in sorted(os.listdir(shard_dir)):
+            if name.endswith(".db"):
+                manifest.merge(f"{shard_dir}/{name}")
+                os.remove(f"{shard_dir}/{name}")
+        if not run:
+            return
+        reports = []
+        unfinished = []
+        for i in range(run['shards']):
+            try:
+                with open(f"{shard_dir}/{run['run_id']}-{i}.done.json") as f:
+                    reports.append(json.load(f))
+            except FileNotFoundError:
+                unfinished.append(i)
+        if unfinished:
+            log(f"Sharded scan {run['run_id']}: {len(reports)} of {run['shards']} shards finished")
+            if any(shard_alive(run, i) for i in unfinished):
+                return run
+            log(f"Sharded scan {run['run_id']}: shards {unfinished} stopped without finishing, dropping the run")
+            for name in os.listdir(shard_dir):
+                os.remove(f"{shard_dir}/{name}")
+            return
+        totals = {}
+        for report in reports:
+            for key, value in report.items():
+                totals[key] = totals.get(key, 0) + value
+        message = f"Sharded scan {run['run_id']} finished: {totals.get('found', 0)} files found, " \
+                  f"{totals.get('scanned', 0)} scanned, {totals.get('failed', 0)} failed"
+        if event.get('incremental', incremental_scan) and not run.get('restricted'):
+            message += f", {manifest.prune(run['run_id'])} deleted files forgotten"
+        log(message)
+        for name in os.listdir(shard_dir):
+            os.remove(f"{shard_dir}/{name}")
+
+    def shard_alive(run, i):
+        """
+        Whether the worker of an unfinished shard may still be running. Every slice saves the
+        checkpoint of the shard before it invokes the next one, so a shard not heard from for
+        longer than a slice, plus as long again for the invocation to start, has stopped.
+        """
+        state = Checkpoint(f"{shard_dir}/{run['run_id']}-{i}.checkpoint.json").load()
+        if state is None:
+            last_seen = run.get('started_at', 0)
+        elif not state.get('token'):
+            # the last slice ran out of time without invoking the next one
+            return False
+        else:
+            last_seen = state['saved_at']
+        return time.time() - last_seen < 2 * LAMBDA_MAX_SECONDS
+
+    def coordinate(count):
+        manifest = Manifest(f"{state_dir}/manifest.db")
+        if collect_shards(manifest):
+            # shards of two runs would scan the same files and race on the manifest
+            manifest.save()
+            manifest.close()
+            log("Coordinator: the last sharded scan is still running, not dispatching a new one")
+            return
+        shards = plan_shards(scope.roots, count, manifest, skip_dir)
+        manifest.save()
+        manifest.close()
+
+        run_id = str(time.time_ns())
+        Checkpoint(f"{shard_dir}/run.json").save({'run_id': run_id, 'shards': len(shards),
+                                                  'restricted': scope.restricted, 'started_at': time.time()})
+        log(f"Coordinator: dispatching {len(shards)} shards of run {run_id}")
+        # the workers get the exclusions and file rules along with their shard
+        events = [dict(event, **{
+            'scan_type': 'shard',
+            'shard': shard,
+            'shard_id': i,
+            'run_id': run_id,
+            'incremental': event.get('incremental', incremental_scan),
+        }) for i, shard in enumerate(shards)]
+        make_executor(shard_executor, context).dispatch(events)
+
+        if shard_executor == "local":
+            # the local executor waits for its workers, their results can be collected right away
+            manifest = Manifest(f"{state_dir}/manifest.db")
+            collect_shards(manifest)
+            manifest.save()
+            manifest.close()
+
+    def skip_dir(path):
+        return path == state_dir or scope.skip_dir(path)
+
     # Assign the API key to a variable
     secret_id = os.environ['secret_name']
     apikey = get_apikey()
     
+    # directories and files covered by the scan
+    scope = make_scope(event, mount_dir)
+
     # Init the Scan
     init = init(v1_region, apikey)
-    
-    # dictionary to store all scan results
-    all_scan_results = {}
-
-    # If manual scan is set to true, scan the files
-    if scan_type == "manual":
-        print("Manual scan is set to true, scanning selected files...")
-        files = event.get('files')
-        if files:
-            for file in files:
-                print("Processing target: ", file)
-                scan = json.loads(scan_file(file, init))
-                print("Scan Result: ", scan)
-                print("Sending result to SNS...")
-                processed_event = str(scan)
-                sns.publish(TopicArn=topic_arn,Message=processed_event)
-                print(f"Results of the file {file} published on SNS")
-                all_scan_results[file] = scan
-        else:
-            print("Manual scan is enabled, but no targets were provided")
-            
-    else:
-        # Full scan operation
-        # for each file in the mount directory, if is a file, scan it
-        print("Full scan mode: scanning all files...")
-        for root, dirs, files in os.walk(mount_dir):
-            for file in files:
-                file = f"{root}/"+file
-                print("Processing Target: ", file)
-                scan = json.loads(scan_file(file, init))
-                print("Scan Result: ", scan)
-                processed_event = str(scan)
-                sns.publish(TopicArn=topic_arn,Message=processed_event)
-                print(f"Results of the file {file} published on SNS")
-                all_scan_results[file] = scan
-    
-    # quit the gRPC client
-    quit = quit(init)
\ No newline at end of file
+    try:
+        # results are streamed to the sinks as they come in, never kept in memory
+        sink = make_sink(result_sinks, sns, topic_arn, results_dir)
+        try:
+            # If manual scan is set to true, scan the files
+            if scan_type == "manual":
+                log("Manual scan is set to true, scanning selected files...")
+                files = event.get('files') or []
+                directories = event.get('directories')
+                if directories:
+                    # files the walk of the directories reaches anyway are scanned once
+                    files = [file for file in files if not scope.covers(file)]
+                if files or directories:
+                    engine = make_engine()
+                    counts, _ = engine.run(scope.roots if directories else [], scope.includes,
+                                           lambda file, st, result: report(file, result), skip_dir=skip_dir,
+                                           files=files, dedupe=content_index(),
+                                           priority=make_priority(event.get('order', scan_order)),
+                                           fail=sink.write_failure)
+                    log(f"Manual scan: {counts['scanned']} files scanned, {counts['skipped']} excluded, "
+                        f"{counts['failed']} failed, {counts['linked'] + counts['duplicates']} duplicates")
+                else:
+                    log("Manual scan is enabled, but no targets were provided")
+
+            elif scan_type == "shard":
+                # Worker of a sharded full scan
+                shard = {'id': event['shard_id'], 'run_id': event['run_id']}
+                checkpoint = Checkpoint(f"{shard_dir}/{shard['run_id']}-{shard['id']}.checkpoint.json")
+                state = checkpoint.load() if event.get('resume_token') else None
+                if event.get('resume_token') and (not state or state.get('token') != event['resume_token']):
+                    # a retried or late resume of a slice that already ran, never start the shard over
+                    log("Stale resume of a shard, skipping this run")
+                else:
+                    scan_tree(event['shard'], state, checkpoint, shard)
+
+            elif event.get('shards', scan_shards) > 1:
+                # Coordinator of a sharded full scan
+                coordinate(event.get('shards', scan_shards))
+
+            else:
+                # Full scan operation
+                # for each file in the mount directory, if is a file, scan it
+                checkpoint = Checkpoint(f"{state_dir}/checkpoint.json")
+                state = checkpoint.load() if event.get('resume', True) else None
+                if event.get('resume_token') and (not state or state.get('token') != event['resume_token']):
+                    # a retried or late resume of a slice that already ran, never start the scan over
+                    log("Stale resume of the last full scan, skipping this run")
+                elif state and state.get('token') and event.get('resume_token') != state['token'] \
+                        and time.time() - state['saved_at'] < LAMBDA_MAX_SECONDS:
+                    log("Another invocation is resuming the last full scan, skipping this run")
+                else:
+                    scan_tree({'dirs': scope.roots, 'shallow_dirs': []}, state, checkpoint)
+        finally:
+            sink.close()
+    finally:
+        # quit the gRPC client, also when the scan failed
+        quit(init)
@@ -0,0 +1,147 @@
+import fnmatch
+import os
+import re
+
+# key of the rule kept on a trie node, path components are always strings
+_RULE = None
+# options that fall back to the comma separated environment variable of the same name
+ENV_OPTIONS = ("directories_exclusions", "file_exclusions", "extensions", "excluded_extensions")
+
+
+def _is_glob(pattern):
+    return any(c in pattern for c in "*?[")
+
+
+def _compile(patterns):
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{fnmatch.translate(pattern)})" for pattern in patterns))
+
+
+def _extension(name):
+    name = name.lower()
+    return name if name.startswith(".") else "." + name
+
+
+class Scope:
+    """
+    Which directories and files a scan covers. Included and excluded directories are compiled
+    into a trie of path components, the deepest directory listed decides, so a directory can be
+    included inside an excluded one. Excluded directories are pruned from the walk and never
+    listed, file rules are checked on the stat the walk already has, before the file is read.
+
+    Absolute paths are matched exactly, patterns with a slash are globs matched against the
+    whole path and patterns without one are matched against the name, like ".git" or "*.tmp".
+    """
+
+    def __init__(self, directories=(), directories_exclusions=(), file_exclusions=(), max_file_size=None,
+                 extensions=(), excluded_extensions=(), default_root="/mnt/efs"):
+        self.trie = {}
+        dir_globs, dir_names = [], []
+        for path in directories:
+            self._mark(path, True)
+        for pattern in directories_exclusions:
+            if not _is_glob(pattern) and pattern.startswith("/"):
+                self._mark(pattern, False)
+            else:
+                (dir_globs if "/" in pattern else dir_names).append(pattern.rstrip("/"))
+        self.dir_globs = _compile(dir_globs)
+        self.dir_names = _compile(dir_names)
+
+        self.file_exclusions = set()
+        file_globs, file_names = [], []
+        for pattern in file_exclusions:
+            if not _is_glob(pattern) and pattern.startswith("/"):
+                self.file_exclusions.add(os.path.normpath(pattern))
+            else:
+                (file_globs if "/" in pattern else file_names).append(pattern)
+        self.file_globs = _compile(file_globs)
+        self.file_names = _compile(file_names)
+
+        self.max_file_size = max_file_size
+        self.extensions = {_extension(e) for e in extensions}
+        self.excluded_extensions = {_extension(e) for e in excluded_extensions}
+        self.restricted = bool(directories or directories_exclusions or file_exclusions or max_file_size
+                               or extensions or excluded_extensions)
+
+        self.roots = []
+        for path in sorted({os.path.normpath(path) for path in directories} or [default_root]):
+            # a directory inside another included one is walked along with it
+            if not self.skip_dir(path) and self._rule(os.path.dirname(path)) is not True:
+                self.roots.append(path)
+
+    def _mark(self, path, include):
+        node = self.trie
+        for part in os.path.normpath(path).strip("/").split("/"):
+            if part:
+                node = node.setdefault(part, {})
+        # excluding a directory wins over including the same one
+        node[_RULE] = include and node.get(_RULE, True)
+
+    def _rule(self, path):
+        node = self.trie
+        rule = node.get(_RULE)
+        for part in path.strip("/").split("/"):
+            node = node.get(part)
+            if node is None:
+                break
+            rule = node.get(_RULE, rule)
+        return rule
+
+    def skip_dir(self, path):
+        if self._rule(path) is False:
+            return True
+        if self.dir_globs is not None and self.dir_globs.match(path):
+            return True
+        return self.dir_names is not None and self.dir_names.match(os.path.basename(path)) is not None
+
+    def select(self, path, st):
+        if path in self.file_exclusions:
+            return False
+        if self.file_globs is not None and self.file_globs.match(path):
+            return False
+        name = os.path.basename(path)
+        if self.file_names is not None and self.file_names.match(name):
+            return False
+        if self.max_file_size is not None and st.st_size > self.max_file_size:
+            return False
+        extension = os.path.splitext(name)[1].lower()
+        if self.extensions and extension not in self.extensions:
+            return False
+        return extension not in self.excluded_extensions
+
+    def covers(self, path):
+        """
+        Whether the walk of the roots reaches a file.
+        """
+        path = os.path.dirname(path)
+        while not self.skip_dir(path):
+            if path in self.roots:
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+        return False
+
+    def includes(self, path, st):
+        """
+        Whether a file named outside of the walk, like the files of a manual scan, is in scope.
+        """
+        return not self.skip_dir(os.path.dirname(path)) and self.select(path, st)
+
+
+def make_scope(event, default_root):
+    """
+    Scope of the scan from the event, the exclusions and file rules default
+    to the environment variables of the same name.
+    """
+    options = {}
+    for name in ENV_OPTIONS:
+        value = event.get(name)
+        if value is None:
+            value = [v.strip() for v in os.environ.get(name, "").split(",") if v.strip()]
+        options[name] = value
+    max_file_size_mb = float(event.get('max_file_size_mb', os.environ.get('max_file_size_mb') or 0))
+    return Scope(event.get('directories') or [], max_file_size=max_file_size_mb * 1024 * 1024 or None,
+                 default_root=default_root, **options)
@@ -0,0 +1,129 @@
+import concurrent.futures
+import heapq
+import json
+import multiprocessing
+import os
+
+import boto3
+
+from checkpoint import LocalContext
+from log import log
+
+# the tree is split into about this many units per shard before they are balanced over the shards
+UNITS_PER_SHARD = 4
+MAX_SPLIT_DEPTH = 4
+# every file costs a scan round trip on top of its bytes, counted as this many bytes
+FILE_COST = 64 * 1024
+
+
+def _estimate(path, manifest):
+    """
+    Estimated cost of scanning a directory: the sizes the manifest recorded under it on earlier
+    runs, or the size of its direct entries when the manifest knows nothing about it yet.
+    """
+    if manifest is not None:
+        with manifest.lock:
+            count, size = manifest.db.execute("SELECT COUNT(*), SUM(size) FROM files WHERE path >= ? AND path < ?",
+                                              (path + "/", path + "0")).fetchone()
+        if count:
+            return size + count * FILE_COST
+    size = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    size += entry.stat(follow_symlinks=False).st_size + FILE_COST
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return max(size, 1)
+
+
+def plan_shards(roots, count, manifest=None, skip_dir=None):
+    """
+    Split the trees under roots into at most count shards of about the same estimated bytes.
+    Directories are split, largest first, until there are enough units to balance. A shard
+    is a dict of dirs scanned recursively and shallow_dirs whose direct files only are scanned.
+    """
+    units = [(-_estimate(root, manifest), root, 0) for root in roots]
+    heapq.heapify(units)
+    leaves = []
+    while units and len(units) + len(leaves) < count * UNITS_PER_SHARD:
+        weight, path, depth = heapq.heappop(units)
+        if depth >= MAX_SPLIT_DEPTH:
+            leaves.append((-weight, path, True))
+            continue
+        files_size = 0
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if skip_dir is None or not skip_dir(entry.path):
+                                subdirs.append(entry.path)
+                        else:
+                            files_size += entry.stat(follow_symlinks=False).st_size + FILE_COST
+                    except OSError:
+                        pass
+        except OSError as e:
+            log(e)
+            continue
+        # the files directly in the directory stay together as one unit
+        leaves.append((max(files_size, 1), path, False))
+        for subdir in subdirs:
+            heapq.heappush(units, (-_estimate(subdir, manifest), subdir, depth + 1))
+    leaves.extend((-weight, path, True) for weight, path, _ in units)
+
+    # longest processing time first: the heaviest unit goes to the lightest shard
+    shards = [(0, i, {"dirs": [], "shallow_dirs": []}) for i in range(count)]
+    for weight, path, recursive in sorted(leaves, reverse=True):
+        total, i, shard = heapq.heappop(shards)
+        shard["dirs" if recursive else "shallow_dirs"].append(path)
+        heapq.heappush(shards, (total + weight, i, shard))
+    return [shard for _, _, shard in sorted(shards, key=lambda s: s[1]) if shard["dirs"] or shard["shallow_dirs"]]
+
+
+class LambdaExecutor:
+    """
+    Sends every shard to an asynchronous invocation of the function,
+    the workers report back through the shard directory on the EFS.
+    """
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.client = boto3.client('lambda')
+
+    def dispatch(self, events):
+        for event in events:
+            self.client.invoke(FunctionName=self.function_name, InvocationType='Event', Payload=json.dumps(event))
+
+
+def _run_local_worker(event, seconds):
+    import scanner_lambda
+    return scanner_lambda.lambda_handler(event, LocalContext(seconds))
+
+
+class LocalExecutor:
+    """
+    Stand-in for tests and local runs, runs the shard workers on a local process pool
+    and waits for them.
+    """
+
+    def __init__(self, processes=None, seconds=900):
+        self.processes = processes
+        self.seconds = seconds
+
+    def dispatch(self, events):
+        # gRPC does not survive fork, every worker starts a fresh interpreter
+        ctx = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(self.processes, mp_context=ctx) as pool:
+            for future in [pool.submit(_run_local_worker, event, self.seconds) for event in events]:
+                future.result()
+
+
+def make_executor(kind, context):
+    if kind == "local":
+        return LocalExecutor()
+    return LambdaExecutor(context.invoked_function_arn)
@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+import time
+
+from log import log
+from publisher import BatchPublisher
+
+# scanResult values of a verdict worth listing in the summary
+MALICIOUS = 1
+SUSPICIOUS = 2
+# the summary lists this many detections, the rest are only counted
+MAX_LISTED = 100
+
+
+class JsonLinesSink:
+    """
+    Appends every result to a JSON-lines file on /tmp or on the EFS, one {path: result} object
+    per line, so nothing but the write buffer is held in memory. Files that could not be
+    scanned get a {path: {"error": ..., "retryable": ...}} line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+
+    def write(self, path, result):
+        line = json.dumps({path: result})
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def write_failure(self, path, error, retryable):
+        self.write(path, {'error': str(error), 'retryable': retryable})
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        log(f"Scan results written to {self.path}")
+
+
+class NotifierSink:
+    """
+    Publishes every result to the SNS topic through a BatchPublisher,
+    failures are left out so subscribers only ever get scan results.
+    """
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+
+    def write(self, path, result):
+        self.publisher.publish(str(result))
+
+    def write_failure(self, path, error, retryable):
+        pass
+
+    def close(self):
+        self.publisher.close()
+        log(f"{self.publisher.published} results published on SNS, {self.publisher.failed} failed")
+
+
+class SummarySink:
+    """
+    Keeps only the number of results per verdict and the first MAX_LISTED
+    malicious or suspicious files and failures, and logs them when closed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"clean": 0, "malicious": 0, "suspicious": 0, "other": 0, "failed": 0}
+        self.detections = []
+        self.failures = []
+
+    def write(self, path, result):
+        verdict = result.get('scanResult')
+        key = {0: "clean", MALICIOUS: "malicious", SUSPICIOUS: "suspicious"}.get(verdict, "other")
+        with self.lock:
+            self.counts[key] += 1
+            if verdict in (MALICIOUS, SUSPICIOUS) and len(self.detections) < MAX_LISTED:
+                names = [m.get('malwareName') for m in result.get('foundMalwares') or []]
+                self.detections.append({'file': path, 'scanResult': verdict, 'malwares': names})
+
+    def write_failure(self, path, error, retryable):
+        with self.lock:
+            self.counts["failed"] += 1
+            if len(self.failures) < MAX_LISTED:
+                self.failures.append({'file': path, 'error': str(error), 'retryable': retryable})
+
+    def close(self):
+        log(f"Scan summary: {json.dumps(self.counts)}")
+        for detection in self.detections:
+            log(f"Detected: {json.dumps(detection)}")
+        unlisted = self.counts["malicious"] + self.counts["suspicious"] - len(self.detections)
+        if unlisted > 0:
+            log(f"... and {unlisted} more detections")
+        for failure in self.failures:
+            log(f"Failed: {json.dumps(failure)}")
+        if self.counts["failed"] > len(self.failures):
+            log(f"... and {self.counts['failed'] - len(self.failures)} more failures")
+
+
+class MultiSink:
+    """
+    Hands every result to each of several sinks.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def write(self, path, result):
+        for sink in self.sinks:
+            sink.write(path, result)
+
+    def write_failure(self, path, error, retryable):
+        for sink in self.sinks:
+            sink.write_failure(path, error, retryable)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def make_sink(kinds, client, topic_arn, results_dir):
+    """
+    Sink for a comma separated list of kinds: "jsonl" writes a file in results_dir,
+    "notifier" publishes to the SNS topic and "summary" logs the totals.
+    """
+    sinks = []
+    for kind in kinds.split(","):
+        kind = kind.strip()
+        if kind == "jsonl":
+            sinks.append(JsonLinesSink(f"{results_dir}/results-{time.time_ns()}-{os.getpid()}.jsonl"))
+        elif kind == "notifier":
+            sinks.append(NotifierSink(BatchPublisher(client, topic_arn)))
+        elif kind == "summary":
+            sinks.append(SummarySink())
+        elif kind:
+            log(f"Ignoring unknown result sink {kind}")
+    return MultiSink(sinks)
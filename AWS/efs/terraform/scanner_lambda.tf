@@ -23,6 +23,25 @@ resource "aws_lambda_function" "scanner" {
       topic_arn = aws_sns_topic.sns_topic.arn
       v1_region = var.v1_region
       secret_name = aws_secretsmanager_secret.apikey.name
+      incremental_scan = var.incremental_scan
+      rescan_max_age_hours = var.rescan_max_age_hours
+      scan_workers = var.scan_workers
+      walk_workers = var.walk_workers
+      resume_invoker = var.resume_invoker
+      checkpoint_margin_seconds = var.checkpoint_margin_seconds
+      scan_shards = var.scan_shards
+      result_sinks = var.result_sinks
+      results_dir = var.results_dir
+      directories_exclusions = join(",", var.directories_exclusions)
+      file_exclusions = join(",", var.file_exclusions)
+      max_file_size_mb = var.max_file_size_mb
+      extensions = join(",", var.extensions)
+      excluded_extensions = join(",", var.excluded_extensions)
+      content_dedupe = var.content_dedupe
+      content_dedupe_min_size_kb = var.content_dedupe_min_size_kb
+      scan_order = var.scan_order
+      scan_retries = var.scan_retries
+      retry_backoff_seconds = var.retry_backoff_seconds
     }
   }
   tags = {
@@ -94,6 +113,15 @@ resource "aws_iam_policy" "scanner-policy" {
         "${aws_sns_topic.sns_topic.arn}"
       ]
     },
+    {
+      "Action": [
+        "lambda:InvokeFunction"
+      ],
+      "Effect": "Allow",
+      "Resource": [
+        "arn:aws:lambda:*:*:function:${var.prefix}-${random_string.random.id}"
+      ]
+    },
     {
       "Action": [
         "logs:CreateLogGroup",
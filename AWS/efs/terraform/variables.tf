@@ -59,3 +59,117 @@ variable "scan_frequency" {
   # default     = "cron(0/5 * ? * FRI *)" # Every 5 minutes on Friday
   default     = "rate(1 hour)" # Every hour
 }
+
+variable "incremental_scan" {
+  description = "Only scan new or changed files in full scans, based on a manifest kept on the EFS"
+  type        = bool
+  default     = true
+}
+
+variable "rescan_max_age_hours" {
+  description = "Rescan unchanged files whose last verdict is older than this many hours in incremental scans"
+  type        = number
+  default     = 168
+}
+
+variable "scan_workers" {
+  description = "Number of files scanned concurrently in full scans"
+  type        = number
+  default     = 8
+}
+
+variable "walk_workers" {
+  description = "Number of directories listed concurrently in full scans"
+  type        = number
+  default     = 4
+}
+
+variable "resume_invoker" {
+  description = "How full scans that run out of time resume: lambda (invoke the function again), none (next schedule)"
+  type        = string
+  default     = "lambda"
+}
+
+variable "checkpoint_margin_seconds" {
+  description = "Seconds before the Lambda timeout at which a full scan stops and saves its checkpoint"
+  type        = number
+  default     = 10
+}
+
+variable "scan_shards" {
+  description = "Number of shards a full scan is split into, each scanned by its own invocation of the function"
+  type        = number
+  default     = 1
+}
+
+variable "result_sinks" {
+  description = "Comma separated sinks scan results are streamed to: notifier, summary and jsonl"
+  type        = string
+  default     = "notifier,summary"
+}
+
+variable "results_dir" {
+  description = "Directory the jsonl result sink writes to, /tmp or a directory on the EFS"
+  type        = string
+  default     = "/tmp"
+}
+
+variable "directories_exclusions" {
+  description = "Directories never walked by scans: absolute paths, globs or directory names"
+  type        = list(string)
+  default     = []
+}
+
+variable "file_exclusions" {
+  description = "Files never scanned: absolute paths, globs or file names"
+  type        = list(string)
+  default     = []
+}
+
+variable "max_file_size_mb" {
+  description = "Files larger than this are not scanned, 0 for no limit"
+  type        = number
+  default     = 0
+}
+
+variable "extensions" {
+  description = "Only files with these extensions are scanned, all files when empty"
+  type        = list(string)
+  default     = []
+}
+
+variable "excluded_extensions" {
+  description = "Files with these extensions are not scanned"
+  type        = list(string)
+  default     = []
+}
+
+variable "content_dedupe" {
+  description = "Scan files with the same content once per invocation and hand the verdict to all of them"
+  type        = bool
+  default     = false
+}
+
+variable "content_dedupe_min_size_kb" {
+  description = "Smallest file in KB compared for duplicate content"
+  type        = number
+  default     = 64
+}
+
+variable "scan_order" {
+  description = "Order queued files are scanned in: walk, newest or risk"
+  type        = string
+  default     = "walk"
+}
+
+variable "scan_retries" {
+  description = "Times a file whose scan failed for a passing reason is scanned again in the same invocation"
+  type        = number
+  default     = 3
+}
+
+variable "retry_backoff_seconds" {
+  description = "Seconds before the first retry of a failed scan, doubled for every further attempt"
+  type        = number
+  default     = 1
+}
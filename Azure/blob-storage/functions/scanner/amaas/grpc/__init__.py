@@ -4,17 +4,37 @@ from typing import BinaryIO, List
 
 import grpc
 import os
+import time
 import io
 
 from .protos import scan_pb2
-from .protos import scan_pb2_grpc
 from .exception import AMaasException
 from .exception import AMaasErrorCode
 from .util import _init_by_region_util
 from .util import _init_util
+from .util import _region_host
+from .util import _warmup_util
 from .util import _validate_tags
-from .util import _digest_hex
+from .util import _select_compression
+from .util import _resolve_timeout
+from .util import ScanTimeoutPolicy
+from .util import deadline_from_context
+from .util import _file_digests
+from .util import _encode_run_chunk
+from .util import _ScanStub
+from .util import _byte_budget
+from .util import set_inflight_byte_limit
+from .util import inflight_bytes
+from .util import _detached_digests
+from .util import DIGEST_DEFERRED
 from .util import APP_NAME_HEADER, APP_NAME_FILE_SCAN
+from .balancer import ChannelGroup
+from .balancer import _init_group_util
+from .balancer import _init_sharded_util
+from .balancer import _member_channels
+from .profiling import _ScanProfile
+from .profiling import _active_profile
+from .profiling import set_profiling
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -23,6 +43,7 @@ logger.setLevel(LOG_LEVEL)
 logger.propagate = False
 
 timeout_in_seconds = int(os.environ.get('TM_AM_SCAN_TIMEOUT_SECS', 300))
+warmup_timeout_in_seconds = int(os.environ.get('TM_AM_WARMUP_TIMEOUT_SECS', 10))
 
 
 class _Pipeline:
@@ -32,58 +53,140 @@ class _Pipeline:
 
     def __init__(self):
         self._message = 0
+        self._closed = False
         self._producer_lock = threading.Lock()
         self._consumer_lock = threading.Lock()
         self._consumer_lock.acquire()
 
     def get_message(self):
         self._consumer_lock.acquire()
+        if self._closed:
+            return None
         message = self._message
         self._producer_lock.release()
         return message
 
     def set_message(self, message):
+        if self._closed:
+            return
         self._producer_lock.acquire()
         self._message = message
         self._consumer_lock.release()
 
+    def close(self):
+        """
+        Wake up whichever side is waiting, the consumer then gets None and stops.
+        """
+        self._closed = True
+        for lock in (self._consumer_lock, self._producer_lock):
+            try:
+                lock.release()
+            except RuntimeError:
+                pass
 
-def init_by_region(region, api_key, enable_tls=True, ca_cert=None):
-    return _init_by_region_util(region, api_key, enable_tls, ca_cert, False)
 
+class CancelToken:
+    """
+    Cancels the sync scans it is passed to, e.g. scan_file(channel, file_name, cancel_token=token).
+    """
 
-def init(host, api_key=None, enable_tls=False, ca_cert=None):
-    return _init_util(host, api_key, enable_tls, ca_cert, False)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks = self._callbacks[:]
+            self._callbacks.clear()
+        for callback in callbacks:
+            callback()
+
+    def _add_callback(self, callback) -> None:
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def _remove_callback(self, callback) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+def init_by_region(region, api_key, enable_tls=True, ca_cert=None, eager=False, channels=1, max_channels=None):
+    if channels > 1 or (max_channels or 0) > 1:
+        channel = _init_sharded_util(_region_host(region), api_key, enable_tls, ca_cert, False, channels, max_channels)
+    else:
+        channel = _init_by_region_util(region, api_key, enable_tls, ca_cert, False)
+    if eager:
+        warmup(channel)
+    return channel
+
+
+def init(host, api_key=None, enable_tls=False, ca_cert=None, eager=False, policy=None, channels=1,
+         max_channels=None):
+    """
+    host is either a single host:port, a list of them, or a host:port whose name resolves to
+    several scanners when a load balancing policy is given.
+    """
+    if isinstance(host, (list, tuple)) or policy:
+        channel = _init_group_util(host, api_key, enable_tls, ca_cert, False, policy)
+    elif channels > 1 or (max_channels or 0) > 1:
+        channel = _init_sharded_util(host, api_key, enable_tls, ca_cert, False, channels, max_channels)
+    else:
+        channel = _init_util(host, api_key, enable_tls, ca_cert, False)
+    if eager:
+        warmup(channel)
+    return channel
+
+
+def warmup(channel: grpc.Channel, timeout: float = None) -> None:
+    """
+    Resolve, connect and finish the TLS handshake of a channel before the first scan.
+    """
+    for c in _member_channels(channel):
+        _warmup_util(c, warmup_timeout_in_seconds if timeout is None else timeout)
 
 
 def _generate_messages(pipeline: _Pipeline, data_reader: BinaryIO, bulk: bool, stats: dict) -> None:
     responses = []
+    # scan_buffer already holds the budget for the whole buffer
+    governed = not isinstance(data_reader, io.BytesIO)
 
     while True:
         for r in responses:
             if r[0] == "INIT":
-                response = r[1]
+                yield r[1]
             elif r[0] == "RUN":
                 offset = r[1]
                 length = r[2]
-                data_reader.seek(offset)
-                chunk = data_reader.read(length)
-                response = scan_pb2.C2S(
-                    stage=scan_pb2.STAGE_RUN,
-                    file_name=None,
-                    rs_size=0,
-                    offset=offset,
-                    chunk=chunk,
-                )
-                stats["total_upload"] = stats.get("total_upload", 0) + len(chunk)
+                # the chunk counts against the byte budget until gRPC asks for the next message
+                reserved = _byte_budget.acquire(length) if governed else 0
+                try:
+                    response, n = _encode_run_chunk(data_reader, offset, length)
+                    stats["total_upload"] = stats.get("total_upload", 0) + n
+                    yield response
+                finally:
+                    _byte_budget.release(reserved)
             else:
                 raise AMaasException(AMaasErrorCode.MSG_ID_ERR_UNEXPECTED_CMD_AND_STAGE, "None", r[0])
-            yield response
 
         responses.clear()
         message = pipeline.get_message()
 
-        if message.stage == scan_pb2.STAGE_INIT:
+        if message is None:
+            logger.debug("pipeline closed, stop generating C2S messages...")
+            break
+        elif message.stage == scan_pb2.STAGE_INIT:
             logger.debug("stage INIT")
             responses.append(("INIT", message))
         elif message.stage == scan_pb2.STAGE_RUN:
@@ -122,26 +225,64 @@ def quit(handle):
 
 
 def _scan_data(channel: grpc.Channel, data_reader: BinaryIO, size: int, identifier: str, tags: List[str],
-               pml: bool, feedback: bool, verbose: bool, digest: bool) -> str:
+               pml: bool, feedback: bool, verbose: bool, digest: bool,
+               compression: str = None, stats: dict = None, timeout=None, deadline: float = None,
+               cancel_token: CancelToken = None, on_progress=None, on_verdict=None) -> str:
+    """
+    on_progress(bytes_uploaded, total, round_trips) is called each time the scanner asks for more data
+    and once more when it answers, on_verdict(result) as soon as the answer arrives.
+    An exception raised by either aborts the scan.
+    """
     _validate_tags(tags)
-    stub = scan_pb2_grpc.ScanStub(channel)
+    if cancel_token is not None and cancel_token.cancelled:
+        raise AMaasException(AMaasErrorCode.MSG_ID_ERR_SCAN_CANCELLED)
+    scan_timeout = _resolve_timeout(size, timeout, deadline, timeout_in_seconds)
+    expires = time.monotonic() + scan_timeout
+    stub = _ScanStub(channel)
     pipeline = _Pipeline()
-    stats = {}
+    stats = {} if stats is None else stats
     result = None
+    responses = None
     bulk = True
+    digest_worker = None
+    digest_stop = threading.Event()
     file_sha1 = ""
     file_sha256 = ""
+    round_trips = 0
+
+    call_compression = _select_compression(data_reader, size, compression, stats)
 
-    if digest:
-        file_sha1 = "sha1:" + _digest_hex(data_reader, "sha1")
-        file_sha256 = "sha256:" + _digest_hex(data_reader, "sha256")
+    def cancel():
+        if responses is not None:
+            responses.cancel()
+        pipeline.close()
+        # stop hashing too, the scan returns without reading the rest of the file
+        digest_stop.set()
 
     try:
         metadata = (
             (APP_NAME_HEADER, APP_NAME_FILE_SCAN),
         )
-        responses = stub.Run(_generate_messages(pipeline, data_reader, bulk, stats), timeout=timeout_in_seconds,
-                             metadata=metadata)
+        requests = _generate_messages(pipeline, data_reader, bulk, stats)
+        profile = _active_profile()
+        if profile is not None:
+            requests = profile.attach_iterator(requests)
+        responses = stub.Run(requests, timeout=expires - time.monotonic(), metadata=metadata,
+                             compression=call_compression)
+        if cancel_token is not None:
+            cancel_token._add_callback(cancel)
+
+        # the call is already connecting, hash in the meantime, INIT goes out once the digests are known
+        if digest == DIGEST_DEFERRED:
+            digest_worker = threading.Thread(target=_detached_digests, args=(data_reader, stats, digest_stop),
+                                             daemon=True)
+            digest_worker.start()
+        elif digest:
+            digests = _file_digests(data_reader, digest_stop)
+            if digests is None:
+                raise AMaasException(AMaasErrorCode.MSG_ID_ERR_SCAN_CANCELLED)
+            file_sha1, file_sha256 = digests
+
         message = scan_pb2.C2S(stage=scan_pb2.STAGE_INIT,
                                file_name=identifier,
                                rs_size=size,
@@ -159,23 +300,39 @@ def _scan_data(channel: grpc.Channel, data_reader: BinaryIO, size: int, identifi
 
         for response in responses:
             if response.cmd == scan_pb2.CMD_RETR:
+                # everything asked for so far has been sent once the next request comes in
+                uploaded = stats.get("total_upload", 0)
                 pipeline.set_message(response)
+                if on_progress is not None:
+                    on_progress(uploaded, size, round_trips)
+                round_trips += 1
             elif response.cmd == scan_pb2.CMD_QUIT:
                 result = response.result
                 pipeline.set_message(response)
                 logger.debug("receive QUIT, exit loop...")
+                if on_progress is not None:
+                    on_progress(stats.get("total_upload", 0), size, round_trips)
+                if on_verdict is not None:
+                    on_verdict(result)
                 break
             else:
                 logger.debug("unknown command...")
                 raise AMaasException(AMaasErrorCode.MSG_ID_ERR_UNKNOWN_CMD, response.cmd)
 
+        if digest_worker is not None:
+            digest_worker.join()
+
         total_upload = stats.get("total_upload", 0)
         logger.debug(f"total upload {total_upload} bytes")
+        if "compression_ratio" in stats:
+            logger.debug(f"compression {stats['compression']}, ratio {stats['compression_ratio']}")
 
     except AMaasException:
         raise
     except grpc.RpcError as rpc_error:
-        if "429" in str(rpc_error):
+        if cancel_token is not None and cancel_token.cancelled:
+            raise AMaasException(AMaasErrorCode.MSG_ID_ERR_SCAN_CANCELLED)
+        elif "429" in str(rpc_error):
             raise AMaasException(AMaasErrorCode.MSG_ID_ERR_RATE_LIMIT_EXCEEDED)
         elif rpc_error.code() == grpc.StatusCode.UNAUTHENTICATED:
             raise AMaasException(AMaasErrorCode.MSG_ID_ERR_KEY_AUTH_FAILED)
@@ -183,12 +340,30 @@ def _scan_data(channel: grpc.Channel, data_reader: BinaryIO, size: int, identifi
             raise AMaasException(AMaasErrorCode.MSG_ID_GRPC_ERROR, rpc_error.code().value[0], rpc_error.details())
     except Exception as err:
         raise AMaasException(AMaasErrorCode.MSG_ID_ERR_UNEXPECTED_ERROR, str(err))
+    finally:
+        if cancel_token is not None:
+            cancel_token._remove_callback(cancel)
+        if result is None and responses is not None:
+            responses.cancel()
+        # never leave the gRPC request thread blocked in the generator
+        pipeline.close()
+        # a failed or cancelled scan does not need the digests, stop reading the file for them
+        digest_stop.set()
 
     return result
 
 
+def _scan(channel, data_reader, size, identifier, *args, **kwargs) -> str:
+    with _ScanProfile(identifier):
+        if isinstance(channel, ChannelGroup):
+            return channel._call(_scan_data, data_reader, size, identifier, *args, **kwargs)
+        return _scan_data(channel, data_reader, size, identifier, *args, **kwargs)
+
+
 def scan_file(channel: grpc.Channel, file_name: str, tags: List[str] = None,
-              pml: bool = False, feedback: bool = False, verbose: bool = False, digest: bool = True) -> str:
+              pml: bool = False, feedback: bool = False, verbose: bool = False, digest: bool = True,
+              compression: str = None, stats: dict = None, timeout=None, deadline: float = None,
+              cancel_token: CancelToken = None, on_progress=None, on_verdict=None) -> str:
     try:
         f = open(file_name, "rb")
         fid = os.path.basename(file_name)
@@ -200,10 +375,23 @@ def scan_file(channel: grpc.Channel, file_name: str, tags: List[str] = None,
         logger.debug("Permission error: " + str(err))
         raise AMaasException(AMaasErrorCode.MSG_ID_ERR_FILE_NO_PERMISSION, file_name)
 
-    return _scan_data(channel, f, n, fid, tags, pml, feedback, verbose, digest)
+    try:
+        return _scan(channel, f, n, fid, tags, pml, feedback, verbose, digest, compression=compression, stats=stats,
+                     timeout=timeout, deadline=deadline, cancel_token=cancel_token, on_progress=on_progress,
+                     on_verdict=on_verdict)
+    finally:
+        f.close()
 
 
 def scan_buffer(channel: grpc.Channel, bytes_buffer: bytes, uid: str, tags: List[str] = None,
-                pml: bool = False, feedback: bool = False, verbose: bool = False, digest: bool = True) -> str:
-    f = io.BytesIO(bytes_buffer)
-    return _scan_data(channel, f, len(bytes_buffer), uid, tags, pml, feedback, verbose, digest)
+                pml: bool = False, feedback: bool = False, verbose: bool = False, digest: bool = True,
+                compression: str = None, stats: dict = None, timeout=None, deadline: float = None,
+                cancel_token: CancelToken = None, on_progress=None, on_verdict=None) -> str:
+    reserved = _byte_budget.acquire(len(bytes_buffer))
+    try:
+        f = io.BytesIO(bytes_buffer)
+        return _scan(channel, f, len(bytes_buffer), uid, tags, pml, feedback, verbose, digest,
+                     compression=compression, stats=stats, timeout=timeout, deadline=deadline,
+                     cancel_token=cancel_token, on_progress=on_progress, on_verdict=on_verdict)
+    finally:
+        _byte_budget.release(reserved)
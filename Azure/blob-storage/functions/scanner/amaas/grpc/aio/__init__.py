@@ -1,19 +1,40 @@
+import asyncio
+import concurrent.futures
 import io
 import os
+import threading
+import time
 from typing import BinaryIO, List
 
 import grpc
 import logging
 
 from ..protos import scan_pb2
-from ..protos import scan_pb2_grpc
 from ..exception import AMaasException
 from ..exception import AMaasErrorCode
 from ..util import _init_by_region_util
 from ..util import _init_util
+from ..util import _region_host
 from ..util import _validate_tags
-from ..util import _digest_hex
+from ..util import _select_compression
+from ..util import _resolve_timeout
+from ..util import ScanTimeoutPolicy
+from ..util import deadline_from_context
+from ..util import _file_digests
+from ..util import _detached_digests
+from ..util import DIGEST_DEFERRED
+from ..util import _encode_run_chunk
+from ..util import _ScanStub
+from ..util import _byte_budget
+from ..util import set_inflight_byte_limit
+from ..util import inflight_bytes
 from ..util import APP_NAME_HEADER, APP_NAME_FILE_SCAN
+from ..balancer import ChannelGroup
+from ..balancer import _init_group_util
+from ..balancer import _init_sharded_util
+from ..balancer import _member_channels
+from ..profiling import _ScanProfile
+from ..profiling import set_profiling
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -22,14 +43,81 @@ logger.setLevel(LOG_LEVEL)
 logger.propagate = False
 
 timeout_in_seconds = int(os.environ.get('TM_AM_SCAN_TIMEOUT_SECS', 300))
+warmup_timeout_in_seconds = int(os.environ.get('TM_AM_WARMUP_TIMEOUT_SECS', 10))
 
+# digests and file reads run on a small dedicated pool so they never block the event loop,
+# its size bounds how many of them run at once across all scans
+io_concurrency = int(os.environ.get('TM_AM_AIO_IO_CONCURRENCY', 4))
+_io_executor = None
 
-def init_by_region(region, api_key, enable_tls=True, ca_cert=None):
-    return _init_by_region_util(region, api_key, enable_tls, ca_cert, True)
 
+def _run_io(fn, *args) -> asyncio.Future:
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=io_concurrency,
+                                                             thread_name_prefix="amaas-aio-io")
+    return asyncio.get_running_loop().run_in_executor(_io_executor, fn, *args)
 
-def init(host, api_key=None, enable_tls=False, ca_cert=None):
-    return _init_util(host, api_key, enable_tls, ca_cert, True)
+
+async def _read_chunk(data_reader: BinaryIO, offset: int, length: int):
+    if isinstance(data_reader, io.BytesIO):
+        # reading from memory never blocks and scan_buffer already holds the budget for it
+        return _encode_run_chunk(data_reader, offset, length) + (0,)
+
+    # the chunk counts against the byte budget until it has been written
+    reserved = await _byte_budget.acquire_async(length)
+    try:
+        return await _run_io(_encode_run_chunk, data_reader, offset, length) + (reserved,)
+    except BaseException:
+        _byte_budget.release(reserved)
+        raise
+
+
+def _discard_result(future: asyncio.Future) -> None:
+    if not future.cancelled():
+        future.exception()
+
+
+def _release_unused_chunk(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is None:
+        _byte_budget.release(future.result()[2])
+
+
+def init_by_region(region, api_key, enable_tls=True, ca_cert=None, eager=False, channels=1, max_channels=None):
+    if channels > 1 or (max_channels or 0) > 1:
+        channel = _init_sharded_util(_region_host(region), api_key, enable_tls, ca_cert, True, channels, max_channels)
+    else:
+        channel = _init_by_region_util(region, api_key, enable_tls, ca_cert, True)
+    if eager:
+        # start connecting in the background, await warmup() to wait for the channel to be ready
+        for c in _member_channels(channel):
+            c.get_state(try_to_connect=True)
+    return channel
+
+
+def init(host, api_key=None, enable_tls=False, ca_cert=None, eager=False, policy=None, channels=1,
+         max_channels=None):
+    if isinstance(host, (list, tuple)) or policy:
+        channel = _init_group_util(host, api_key, enable_tls, ca_cert, True, policy)
+    elif channels > 1 or (max_channels or 0) > 1:
+        channel = _init_sharded_util(host, api_key, enable_tls, ca_cert, True, channels, max_channels)
+    else:
+        channel = _init_util(host, api_key, enable_tls, ca_cert, True)
+    if eager:
+        for c in _member_channels(channel):
+            c.get_state(try_to_connect=True)
+    return channel
+
+
+async def warmup(channel: grpc.aio.Channel, timeout: float = None) -> None:
+    """
+    Resolve, connect and finish the TLS handshake of a channel before the first scan.
+    """
+    timeout = warmup_timeout_in_seconds if timeout is None else timeout
+    try:
+        await asyncio.wait_for(asyncio.gather(*[c.channel_ready() for c in _member_channels(channel)]), timeout)
+    except asyncio.TimeoutError:
+        raise AMaasException(AMaasErrorCode.MSG_ID_ERR_CHANNEL_NOT_READY, timeout)
 
 
 async def quit(handle):
@@ -40,24 +128,41 @@ async def quit(handle):
 
 
 async def _scan_data(channel: grpc.Channel, data_reader: BinaryIO, size: int, identifier: str, tags: List[str],
-                     pml: bool, feedback: bool, verbose: bool, digest: bool) -> str:
+                     pml: bool, feedback: bool, verbose: bool, digest: bool,
+                     compression: str = None, stats: dict = None, timeout=None, deadline: float = None,
+                     on_progress=None, on_verdict=None) -> str:
+    """
+    on_progress(bytes_uploaded, total, round_trips) is called each time the scanner asks for more data
+    and once more when it answers, on_verdict(result) as soon as the answer arrives.
+    An exception raised by either aborts the scan.
+    """
     _validate_tags(tags)
-    stub = scan_pb2_grpc.ScanStub(channel)
-    stats = {}
+    scan_timeout = _resolve_timeout(size, timeout, deadline, timeout_in_seconds)
+    expires = time.monotonic() + scan_timeout
+    stub = _ScanStub(channel)
+    stats = {} if stats is None else stats
     result = None
+    call = None
     bulk = True
+    pending_digests = None
+    digest_stop = threading.Event()
     file_sha1 = ""
     file_sha256 = ""
+    round_trips = 0
 
-    if digest:
-        file_sha1 = "sha1:" + _digest_hex(data_reader, "sha1")
-        file_sha256 = "sha256:" + _digest_hex(data_reader, "sha256")
+    call_compression = await _run_io(_select_compression, data_reader, size, compression, stats)
 
     try:
         metadata = (
             (APP_NAME_HEADER, APP_NAME_FILE_SCAN),
         )
-        call = stub.Run(timeout=timeout_in_seconds, metadata=metadata)
+        call = stub.Run(timeout=expires - time.monotonic(), metadata=metadata, compression=call_compression)
+
+        # the call connects while the digests are computed, INIT goes out once they are known
+        if digest == DIGEST_DEFERRED:
+            pending_digests = _run_io(_detached_digests, data_reader, stats, digest_stop)
+        elif digest:
+            file_sha1, file_sha256 = await _run_io(_file_digests, data_reader, digest_stop)
 
         request = scan_pb2.C2S(stage=scan_pb2.STAGE_INIT,
                                file_name=identifier,
@@ -81,6 +186,8 @@ async def _scan_data(channel: grpc.Channel, data_reader: BinaryIO, size: int, id
                 if response.stage != scan_pb2.STAGE_RUN:
                     raise AMaasException(AMaasErrorCode.MSG_ID_ERR_UNEXPECTED_CMD_AND_STAGE, response.cmd,
                                          response.stage)
+                if on_progress is not None:
+                    on_progress(stats.get("total_upload", 0), size, round_trips)
                 length = []
                 offset = []
 
@@ -98,28 +205,38 @@ async def _scan_data(channel: grpc.Channel, data_reader: BinaryIO, size: int, id
                     length.append(response.length)
                     offset.append(response.offset)
 
-                for i in range(len(length)):
-                    logger.debug(f"try to read {length[i]} at offset {offset[i]}")
-                    data_reader.seek(offset[i])
-                    chunk = data_reader.read(length[i])
-
-                    request = scan_pb2.C2S(
-                        stage=scan_pb2.STAGE_RUN,
-                        file_name=None,
-                        rs_size=0,
-                        offset=offset[i],
-                        chunk=chunk)
-
-                    stats["total_upload"] = stats.get(
-                        "total_upload", 0) + len(chunk)
-
-                    await call.write(request)
+                pending = asyncio.ensure_future(_read_chunk(data_reader, offset[0], length[0])) if length else None
+                try:
+                    for i in range(len(length)):
+                        logger.debug(f"try to read {length[i]} at offset {offset[i]}")
+                        request, n, reserved = await pending
+                        pending = None
+                        if i + 1 < len(length):
+                            # read the next range while this one is being written
+                            pending = asyncio.ensure_future(_read_chunk(data_reader, offset[i + 1], length[i + 1]))
+
+                        stats["total_upload"] = stats.get("total_upload", 0) + n
+
+                        try:
+                            await call.write(request)
+                        finally:
+                            _byte_budget.release(reserved)
+                finally:
+                    if pending is not None:
+                        pending.cancel()
+                        pending.add_done_callback(_release_unused_chunk)
+
+                round_trips += 1
             elif response.cmd == scan_pb2.CMD_QUIT:
                 if response.stage != scan_pb2.STAGE_FINI:
                     raise AMaasException(AMaasErrorCode.MSG_ID_ERR_UNEXPECTED_CMD_AND_STAGE, response.cmd,
                                          response.stage)
                 result = response.result
                 logger.debug("receive QUIT, exit loop...")
+                if on_progress is not None:
+                    on_progress(stats.get("total_upload", 0), size, round_trips)
+                if on_verdict is not None:
+                    on_verdict(result)
                 break
             else:
                 logger.debug("unknown command...")
@@ -127,8 +244,13 @@ async def _scan_data(channel: grpc.Channel, data_reader: BinaryIO, size: int, id
 
         await call.done_writing()
 
+        if pending_digests is not None:
+            await pending_digests
+
         total_upload = stats.get("total_upload", 0)
         logger.debug(f"total upload {total_upload} bytes")
+        if "compression_ratio" in stats:
+            logger.debug(f"compression {stats['compression']}, ratio {stats['compression_ratio']}")
 
     except AMaasException:
         raise
@@ -141,12 +263,31 @@ async def _scan_data(channel: grpc.Channel, data_reader: BinaryIO, size: int, id
             raise AMaasException(AMaasErrorCode.MSG_ID_GRPC_ERROR, rpc_error.code().value[0], rpc_error.details())
     except Exception as err:
         raise AMaasException(AMaasErrorCode.MSG_ID_ERR_UNEXPECTED_ERROR, str(err))
+    finally:
+        # on errors and when the task running the scan is cancelled, release the stream right away
+        if result is None and call is not None:
+            call.cancel()
+        # stop hashing, or never start, so the I/O slot is free right away
+        digest_stop.set()
+        if pending_digests is not None:
+            pending_digests.cancel()
+            pending_digests.add_done_callback(_discard_result)
 
     return result
 
 
+async def _scan(channel, data_reader, size, identifier, *args, **kwargs) -> str:
+    # the profile also catches whatever else runs on the event loop during the scan
+    async with _ScanProfile(identifier):
+        if isinstance(channel, ChannelGroup):
+            return await channel._call_async(_scan_data, data_reader, size, identifier, *args, **kwargs)
+        return await _scan_data(channel, data_reader, size, identifier, *args, **kwargs)
+
+
 async def scan_file(channel: grpc.Channel, file_name: str, tags: List[str] = None,
-                    pml: bool = False, feedback: bool = False, verbose: bool = False, digest: bool = True) -> str:
+                    pml: bool = False, feedback: bool = False, verbose: bool = False, digest: bool = True,
+                    compression: str = None, stats: dict = None, timeout=None, deadline: float = None,
+                    on_progress=None, on_verdict=None) -> str:
     try:
         f = open(file_name, "rb")
         fid = os.path.basename(file_name)
@@ -157,10 +298,23 @@ async def scan_file(channel: grpc.Channel, file_name: str, tags: List[str] = Non
     except (PermissionError, IOError) as err:
         logger.debug("Permission error: " + str(err))
         raise AMaasException(AMaasErrorCode.MSG_ID_ERR_FILE_NO_PERMISSION, file_name)
-    return await _scan_data(channel, f, n, fid, tags, pml, feedback, verbose, digest)
+    try:
+        return await _scan(channel, f, n, fid, tags, pml, feedback, verbose, digest, compression=compression,
+                           stats=stats, timeout=timeout, deadline=deadline, on_progress=on_progress,
+                           on_verdict=on_verdict)
+    finally:
+        f.close()
 
 
 async def scan_buffer(channel: grpc.Channel, bytes_buffer: bytes, uid: str, tags: List[str] = None,
-                      pml: bool = False, feedback: bool = False, verbose: bool = False, digest: bool = True) -> str:
-    f = io.BytesIO(bytes_buffer)
-    return await _scan_data(channel, f, len(bytes_buffer), uid, tags, pml, feedback, verbose, digest)
+                      pml: bool = False, feedback: bool = False, verbose: bool = False, digest: bool = True,
+                      compression: str = None, stats: dict = None, timeout=None, deadline: float = None,
+                      on_progress=None, on_verdict=None) -> str:
+    reserved = await _byte_budget.acquire_async(len(bytes_buffer))
+    try:
+        f = io.BytesIO(bytes_buffer)
+        return await _scan(channel, f, len(bytes_buffer), uid, tags, pml, feedback, verbose, digest,
+                           compression=compression, stats=stats, timeout=timeout, deadline=deadline,
+                           on_progress=on_progress, on_verdict=on_verdict)
+    finally:
+        _byte_budget.release(reserved)
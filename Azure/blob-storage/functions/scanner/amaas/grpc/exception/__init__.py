@@ -31,3 +31,9 @@ class AMaasErrorCode(Enum):
     MSG_ID_ERR_RATE_LIMIT_EXCEEDED = "Raised by the SDK library to indicate http 429 too many request error."
     MSG_ID_ERR_INVALID_TAG = "Invalid tag format: %s."
     MSG_ID_ERR_TAG_NUMBER_EXCEED = "Too many tags: %d."
+    MSG_ID_ERR_CHANNEL_NOT_READY = "Channel is not ready after %s seconds."
+    MSG_ID_ERR_INVALID_COMPRESSION = "%s is not a supported compression, value should be one of %s"
+    MSG_ID_ERR_INVALID_POLICY = "%s is not a supported load balancing policy, value should be one of %s"
+    MSG_ID_ERR_NO_ENDPOINT = "No scanner endpoint found for %s."
+    MSG_ID_ERR_SCAN_CANCELLED = "Scan was cancelled."
+    MSG_ID_ERR_DEADLINE_TOO_SHORT = "Only %.2f seconds left before the deadline, not enough to scan."
@@ -0,0 +1,165 @@
+import collections
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+# every job costs at least this many bytes, so floods of tiny files still use up their tenant's share
+MIN_JOB_COST = 64 * 1024
+
+
+class _Tenant:
+    def __init__(self, weight: float, shortest_first: bool):
+        self.weight = weight
+        self.shortest_first = shortest_first
+        self.queue = [] if shortest_first else collections.deque()
+        self.pass_value = 0.0
+        self.dispatched = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+        self.last_delay = 0.0
+
+    def push(self, entry):
+        if self.shortest_first:
+            heapq.heappush(self.queue, entry)
+        else:
+            self.queue.append(entry)
+
+    def pop(self):
+        if self.shortest_first:
+            return heapq.heappop(self.queue)
+        return self.queue.popleft()
+
+
+class FairScheduler:
+    """
+    Weighted fair-share queue of scan jobs for several tenants (buckets, containers, teams).
+    Each tenant is served in proportion to its weight, measured in scanned bytes, so a bulk
+    backfill cannot starve interactive uploads of another tenant. Within a tenant jobs run
+    first-come-first-served, or smallest first with shortest_first=True.
+    """
+
+    def __init__(self, weights: dict = None, default_weight: float = 1.0, shortest_first: bool = False):
+        self._weights = dict(weights or {})
+        self._default_weight = default_weight
+        self._shortest_first = shortest_first
+        self._tenants = {}
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._workers = []
+
+    def _tenant(self, name) -> _Tenant:
+        tenant = self._tenants.get(name)
+        if tenant is None:
+            tenant = _Tenant(self._weights.get(name, self._default_weight), self._shortest_first)
+            self._tenants[name] = tenant
+        return tenant
+
+    def set_weight(self, name, weight: float) -> None:
+        with self._cond:
+            self._weights[name] = weight
+            self._tenant(name).weight = weight
+
+    def submit(self, name, job, size: int = 0) -> None:
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("scheduler is closed")
+            tenant = self._tenant(name)
+            if not tenant.queue:
+                # a tenant coming back from idle does not get credit for the time it was away
+                tenant.pass_value = max(tenant.pass_value, self._virtual_time)
+            key = size if self._shortest_first else 0
+            tenant.push((key, next(self._seq), time.monotonic(), size, job))
+            self._cond.notify()
+
+    def get(self, timeout: float = None):
+        """
+        Next (tenant, job) to run, blocking until one is queued. Returns None once the
+        scheduler is closed and drained, or when the timeout expires.
+        """
+        with self._cond:
+            end = None if timeout is None else time.monotonic() + timeout
+            while True:
+                backlogged = [(t.pass_value, name) for name, t in self._tenants.items() if t.queue]
+                if backlogged:
+                    break
+                if self._closed:
+                    return None
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+            pass_value, name = min(backlogged, key=lambda b: b[0])
+            tenant = self._tenants[name]
+            _, _, queued_at, size, job = tenant.pop()
+
+            self._virtual_time = pass_value
+            tenant.pass_value = pass_value + max(size, MIN_JOB_COST) / tenant.weight
+
+            delay = time.monotonic() - queued_at
+            tenant.dispatched += 1
+            tenant.total_delay += delay
+            tenant.max_delay = max(tenant.max_delay, delay)
+            tenant.last_delay = delay
+            return name, job
+
+    def close(self) -> None:
+        """
+        Stop accepting jobs, get() keeps handing out what is already queued.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def start(self, handler, workers: int) -> None:
+        """
+        Drain the queue on worker threads calling handler(tenant, job) for every job.
+        A job that raises is logged and the worker goes on with the next one.
+        """
+        def work():
+            while True:
+                item = self.get()
+                if item is None:
+                    return
+                try:
+                    handler(*item)
+                except Exception:
+                    logger.exception(f"job of tenant {item[0]} failed")
+
+        for i in range(workers):
+            worker = threading.Thread(target=work, name=f"amaas-scheduler-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def join(self) -> None:
+        self.close()
+        for worker in self._workers:
+            worker.join()
+        self._workers.clear()
+
+    def metrics(self) -> dict:
+        """
+        Queueing delay in seconds and queue length per tenant.
+        """
+        with self._cond:
+            return {
+                name: {
+                    "queued": len(t.queue),
+                    "dispatched": t.dispatched,
+                    "avg_delay": t.total_delay / t.dispatched if t.dispatched else 0.0,
+                    "max_delay": t.max_delay,
+                    "last_delay": t.last_delay,
+                }
+                for name, t in self._tenants.items()
+            }
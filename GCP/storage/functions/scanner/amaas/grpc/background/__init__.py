@@ -0,0 +1,83 @@
+import asyncio
+import concurrent.futures
+import threading
+
+import logging
+import os
+
+from .. import aio
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+
+class _LoopHandle:
+    """
+    Background thread running an event loop, and the amaas.grpc.aio channel that lives on it.
+    Every scan submitted through the handle shares the loop and the channel.
+    """
+
+    def __init__(self, factory):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="amaas-grpc-loop", daemon=True)
+        self._thread.start()
+        # aio channels bind to the loop they are created on
+        self.channel = self.submit(_create_channel(factory)).result()
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def close(self) -> None:
+        if self._loop.is_closed():
+            return
+        try:
+            self.submit(aio.quit(self.channel)).result()
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            logger.debug("background loop stopped")
+
+
+async def _create_channel(factory):
+    return factory()
+
+
+def init_by_region(region, api_key, enable_tls=True, ca_cert=None, **kwargs) -> _LoopHandle:
+    return _LoopHandle(lambda: aio.init_by_region(region, api_key, enable_tls, ca_cert, **kwargs))
+
+
+def init(host, api_key=None, enable_tls=False, ca_cert=None, **kwargs) -> _LoopHandle:
+    return _LoopHandle(lambda: aio.init(host, api_key, enable_tls, ca_cert, **kwargs))
+
+
+def warmup(handle: _LoopHandle, timeout: float = None) -> None:
+    handle.submit(aio.warmup(handle.channel, timeout)).result()
+
+
+def quit(handle: _LoopHandle) -> None:
+    handle.close()
+
+
+def submit_scan_file(handle: _LoopHandle, file_name: str, *args, **kwargs) -> concurrent.futures.Future:
+    """
+    Start a scan on the background loop and return a future of its result.
+    Takes the same parameters as amaas.grpc.aio.scan_file, cancelling the future cancels the scan.
+    """
+    return handle.submit(aio.scan_file(handle.channel, file_name, *args, **kwargs))
+
+
+def submit_scan_buffer(handle: _LoopHandle, bytes_buffer: bytes, uid: str, *args,
+                       **kwargs) -> concurrent.futures.Future:
+    return handle.submit(aio.scan_buffer(handle.channel, bytes_buffer, uid, *args, **kwargs))
+
+
+def scan_file(handle: _LoopHandle, file_name: str, *args, **kwargs) -> str:
+    return submit_scan_file(handle, file_name, *args, **kwargs).result()
+
+
+def scan_buffer(handle: _LoopHandle, bytes_buffer: bytes, uid: str, *args, **kwargs) -> str:
+    return submit_scan_buffer(handle, bytes_buffer, uid, *args, **kwargs).result()
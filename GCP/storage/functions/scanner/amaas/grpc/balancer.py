@@ -0,0 +1,239 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+from typing import List
+
+import grpc
+
+from .exception import AMaasException
+from .exception import AMaasErrorCode
+from .util import _init_util
+
+POLICY_ROUND_ROBIN = "round_robin"
+POLICY_LEAST_STREAMS = "least_streams"
+
+Policies = [POLICY_ROUND_ROBIN, POLICY_LEAST_STREAMS]
+
+# consecutive failures before an endpoint is ejected, and for how long
+ejection_failures = int(os.environ.get('TM_AM_LB_EJECTION_FAILURES', 3))
+ejection_in_seconds = int(os.environ.get('TM_AM_LB_EJECTION_SECS', 30))
+
+# concurrent streams a sharded group lets a sub-channel carry before it opens another one,
+# HTTP/2 servers commonly advertise a MAX_CONCURRENT_STREAMS of 100
+streams_per_channel = int(os.environ.get('TM_AM_STREAMS_PER_CHANNEL', 100))
+
+# gRPC status codes that indicate a problem with the endpoint rather than with the scan
+_ENDPOINT_FAILURE_CODES = {
+    grpc.StatusCode.UNAVAILABLE.value[0],
+    grpc.StatusCode.DEADLINE_EXCEEDED.value[0],
+    grpc.StatusCode.INTERNAL.value[0],
+    grpc.StatusCode.UNKNOWN.value[0],
+}
+
+
+class _Endpoint:
+    def __init__(self, target, channel):
+        self.target = target
+        self.channel = channel
+        self.in_flight = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+
+class ChannelGroup:
+    """
+    Client side load balancer over the channels of several scanner endpoints.
+    Accepted wherever a channel is, e.g. scan_file(group, ...).
+    """
+
+    def __init__(self, endpoints: List[_Endpoint], policy: str = POLICY_ROUND_ROBIN, is_aio_channel: bool = False):
+        self._endpoints = endpoints
+        self._policy = policy
+        self._is_aio_channel = is_aio_channel
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def _candidates(self, now):
+        healthy = [e for e in self._endpoints if e.ejected_until <= now]
+        if healthy:
+            return healthy
+        # every endpoint is ejected, fall back to the one that comes back first
+        return [min(self._endpoints, key=lambda e: e.ejected_until)]
+
+    def _acquire(self) -> _Endpoint:
+        with self._lock:
+            candidates = self._candidates(time.monotonic())
+            if self._policy == POLICY_LEAST_STREAMS:
+                endpoint = min(candidates, key=lambda e: e.in_flight)
+            else:
+                endpoint = candidates[self._next % len(candidates)]
+                self._next += 1
+            endpoint.in_flight += 1
+            return endpoint
+
+    def _release(self, endpoint: _Endpoint, failed: bool) -> None:
+        with self._lock:
+            endpoint.in_flight -= 1
+            if not failed:
+                endpoint.failures = 0
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= ejection_failures:
+                endpoint.ejected_until = time.monotonic() + ejection_in_seconds
+                endpoint.failures = 0
+
+    def _call(self, fn, *args, **kwargs):
+        endpoint = self._acquire()
+        failed = False
+        try:
+            return fn(endpoint.channel, *args, **kwargs)
+        except AMaasException as err:
+            failed = _is_endpoint_failure(err)
+            raise
+        finally:
+            self._release(endpoint, failed)
+
+    async def _call_async(self, fn, *args, **kwargs):
+        endpoint = self._acquire()
+        failed = False
+        try:
+            return await fn(endpoint.channel, *args, **kwargs)
+        except AMaasException as err:
+            failed = _is_endpoint_failure(err)
+            raise
+        finally:
+            self._release(endpoint, failed)
+
+    def channels(self) -> list:
+        with self._lock:
+            return [e.channel for e in self._endpoints]
+
+    def in_flight(self) -> dict:
+        with self._lock:
+            return {e.target: e.in_flight for e in self._endpoints}
+
+    def close(self):
+        channels = self.channels()
+        if self._is_aio_channel:
+            return _close_aio_channels(channels)
+        for channel in channels:
+            channel.close()
+
+
+class ShardedChannelGroup(ChannelGroup):
+    """
+    Group of sub-channels to a single host, each on its own connection.
+    Scans go to the least loaded sub-channel, and the group grows up to max_channels
+    when every sub-channel carries streams_per_channel streams, then shrinks back
+    to min_channels as they go idle.
+    """
+
+    def __init__(self, host: str, factory, min_channels: int, max_channels: int, is_aio_channel: bool = False):
+        self._host = host
+        self._factory = factory
+        self._min_channels = max(min_channels, 1)
+        self._max_channels = max(max_channels, self._min_channels)
+        self._shard_id = 0
+        super().__init__([self._open_shard() for _ in range(self._min_channels)], POLICY_LEAST_STREAMS,
+                         is_aio_channel)
+
+    def _open_shard(self) -> _Endpoint:
+        shard_id = self._shard_id
+        self._shard_id += 1
+        return _Endpoint(f"{self._host}#{shard_id}", self._factory(shard_id))
+
+    def _acquire(self) -> _Endpoint:
+        with self._lock:
+            endpoint = min(self._candidates(time.monotonic()), key=lambda e: e.in_flight)
+            if endpoint.in_flight >= streams_per_channel and len(self._endpoints) < self._max_channels:
+                endpoint = self._open_shard()
+                self._endpoints.append(endpoint)
+            endpoint.in_flight += 1
+            return endpoint
+
+    def _release(self, endpoint: _Endpoint, failed: bool) -> None:
+        super()._release(endpoint, failed)
+        with self._lock:
+            if endpoint.in_flight or len(self._endpoints) <= self._min_channels:
+                return
+            # only drop a sub-channel when the others have plenty of room left
+            load = sum(e.in_flight for e in self._endpoints)
+            if load > (len(self._endpoints) - 1) * streams_per_channel // 2:
+                return
+            self._endpoints.remove(endpoint)
+        _close_channel(endpoint.channel, self._is_aio_channel)
+
+
+def _close_channel(channel, is_aio_channel):
+    if is_aio_channel:
+        asyncio.get_running_loop().create_task(channel.close())
+    else:
+        channel.close()
+
+
+async def _close_aio_channels(channels):
+    for channel in channels:
+        await channel.close()
+
+
+def _is_endpoint_failure(err: AMaasException) -> bool:
+    return err.error_code == AMaasErrorCode.MSG_ID_GRPC_ERROR and err.params[0] in _ENDPOINT_FAILURE_CODES
+
+
+def _member_channels(channel) -> list:
+    if isinstance(channel, ChannelGroup):
+        return channel.channels()
+    return [channel]
+
+
+def _resolve_endpoints(host: str):
+    name, _, port = host.rpartition(':')
+    if not name:
+        raise AMaasException(AMaasErrorCode.MSG_ID_ERR_UNEXPECTED_ERROR, "endpoint must be host:port, got " + host)
+    try:
+        infos = socket.getaddrinfo(name, int(port), type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        raise AMaasException(AMaasErrorCode.MSG_ID_ERR_NO_ENDPOINT, host)
+
+    addresses = []
+    for family, _, _, _, sockaddr in infos:
+        address = f"[{sockaddr[0]}]:{port}" if family == socket.AF_INET6 else f"{sockaddr[0]}:{port}"
+        if address not in addresses:
+            addresses.append(address)
+    return name, addresses
+
+
+def _init_group_util(hosts, api_key=None, enable_tls=False, ca_cert=None, is_aio_channel=False, policy=None):
+    policy = policy or POLICY_ROUND_ROBIN
+    if policy not in Policies:
+        raise AMaasException(AMaasErrorCode.MSG_ID_ERR_INVALID_POLICY, policy, Policies)
+
+    endpoints = []
+    if isinstance(hosts, str):
+        # a single DNS name, balance over every address it resolves to
+        name, addresses = _resolve_endpoints(hosts)
+        options = [('grpc.default_authority', hosts)]
+        if enable_tls:
+            options.append(('grpc.ssl_target_name_override', name))
+        for address in addresses:
+            endpoints.append(_Endpoint(address, _init_util(address, api_key, enable_tls, ca_cert, is_aio_channel,
+                                                           options)))
+    else:
+        for host in hosts:
+            endpoints.append(_Endpoint(host, _init_util(host, api_key, enable_tls, ca_cert, is_aio_channel)))
+
+    if not endpoints:
+        raise AMaasException(AMaasErrorCode.MSG_ID_ERR_NO_ENDPOINT, hosts)
+    return ChannelGroup(endpoints, policy, is_aio_channel)
+
+
+def _init_sharded_util(host, api_key=None, enable_tls=False, ca_cert=None, is_aio_channel=False, channels=1,
+                       max_channels=None):
+    def factory(shard_id):
+        # distinct channel args keep gRPC from sharing one connection between the sub-channels
+        options = [('grpc.use_local_subchannel_pool', 1), ('amaas.channel_shard', shard_id)]
+        return _init_util(host, api_key, enable_tls, ca_cert, is_aio_channel, options)
+
+    return ShardedChannelGroup(host, factory, channels, max_channels or channels, is_aio_channel)
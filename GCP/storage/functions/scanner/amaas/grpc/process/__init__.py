@@ -0,0 +1,211 @@
+import multiprocessing
+import os
+import queue
+import threading
+from typing import Iterable, Iterator, List, Tuple
+
+import logging
+
+from ..exception import AMaasException
+from ..scheduler import FairScheduler
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+SHARD_BY_PATH = "path"
+SHARD_BY_SIZE = "size"
+
+# files per task sent to a worker, bigger batches mean less IPC for trees of small files
+BATCH_SIZE = 64
+
+# channel of the current worker process, created after the worker has started
+_channel = None
+
+
+def _worker_init(by_region: bool, init_args: tuple, init_kwargs: dict) -> None:
+    global _channel
+    from .. import init, init_by_region
+    _channel = init_by_region(*init_args, **init_kwargs) if by_region else init(*init_args, **init_kwargs)
+
+
+def _scan_batch(task: Tuple[List[str], dict]) -> List[Tuple[str, str, str]]:
+    from .. import scan_file
+    batch, scan_kwargs = task
+    results = []
+    for file_name in batch:
+        try:
+            results.append((file_name, scan_file(_channel, file_name, **scan_kwargs), None))
+        except AMaasException as err:
+            # exceptions do not survive pickling, hand back their text
+            results.append((file_name, None, str(err)))
+    return results
+
+
+class ProcessScanner:
+    """
+    Pool of spawned worker processes, each scanning with its own channel.
+    Spawned workers start from a clean interpreter, so no gRPC state is ever inherited through fork.
+    Scans of several tenants share the processes by the weights given here or to set_weight().
+    """
+
+    def __init__(self, by_region: bool, init_args: tuple, init_kwargs: dict, processes: int = None,
+                 weights: dict = None):
+        self.processes = processes or os.cpu_count() or 1
+        context = multiprocessing.get_context("spawn")
+        self._pool = context.Pool(self.processes, initializer=_worker_init,
+                                  initargs=(by_region, init_args, init_kwargs))
+        self._weights = weights
+        self._scheduler = None
+        self._lock = threading.Lock()
+
+    def _fair_scheduler(self) -> FairScheduler:
+        # one dispatcher per process keeps a single batch per process in the pool, so the
+        # scheduler rather than the queue of the pool decides which tenant goes next
+        with self._lock:
+            if self._scheduler is None:
+                self._scheduler = FairScheduler(self._weights)
+                self._scheduler.start(self._run_batch, self.processes)
+            return self._scheduler
+
+    def _run_batch(self, tenant, job) -> None:
+        task, results = job
+        try:
+            results.put(self._pool.apply(_scan_batch, (task,)))
+        except Exception as err:
+            results.put([(file_name, None, str(err)) for file_name in task[0]])
+
+    def set_weight(self, tenant, weight: float) -> None:
+        self._fair_scheduler().set_weight(tenant, weight)
+
+    def metrics(self) -> dict:
+        """
+        Queueing delay and queue length per tenant, see FairScheduler.metrics().
+        """
+        return self._scheduler.metrics() if self._scheduler is not None else {}
+
+    def close(self) -> None:
+        if self._scheduler is not None:
+            self._scheduler.join()
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def init_by_region(region, api_key, enable_tls=True, ca_cert=None, processes: int = None, weights: dict = None,
+                   **kwargs) -> ProcessScanner:
+    return ProcessScanner(True, (region, api_key, enable_tls, ca_cert), kwargs, processes, weights)
+
+
+def init(host, api_key=None, enable_tls=False, ca_cert=None, processes: int = None, weights: dict = None,
+         **kwargs) -> ProcessScanner:
+    return ProcessScanner(False, (host, api_key, enable_tls, ca_cert), kwargs, processes, weights)
+
+
+def quit(handle: ProcessScanner) -> None:
+    handle.close()
+
+
+def _batches_by_path(file_names: Iterable[str]) -> Iterator[List[str]]:
+    # neighbouring paths go to the same worker, which keeps directory lookups warm, the files of a
+    # directory already come together from os.walk, so batches go out while the walk goes on
+    batch = []
+    for file_name in file_names:
+        batch.append(file_name)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _batches_by_size(file_names: Iterable[str], processes: int) -> Iterator[List[str]]:
+    # largest files first so the long scans start early, and batches of roughly equal bytes
+    sized = []
+    for file_name in file_names:
+        try:
+            sized.append((os.path.getsize(file_name), file_name))
+        except OSError:
+            sized.append((0, file_name))
+    sized.sort(reverse=True)
+
+    target = max(sum(size for size, _ in sized) // (processes * 4), 1)
+    batch = []
+    batch_bytes = 0
+    for size, file_name in sized:
+        batch.append(file_name)
+        batch_bytes += size
+        if batch_bytes >= target or len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
+
+
+def _batch_bytes(batch: List[str]) -> int:
+    size = 0
+    for file_name in batch:
+        try:
+            size += os.path.getsize(file_name)
+        except OSError:
+            pass
+    return size
+
+
+def scan_files(handle: ProcessScanner, file_names: Iterable[str], shard: str = SHARD_BY_PATH, tenant=None,
+               **scan_kwargs) -> Iterator[Tuple[str, str, str]]:
+    """
+    Scan files across the worker processes. Yields (file_name, result, error) as batches complete,
+    error is None on success. Takes the scan options of amaas.grpc.scan_file.
+
+    With a tenant, e.g. a bucket or a team, the batches wait in a fair-share queue, so scans of
+    several tenants running at once on the same handle get the processes in proportion to the
+    weights of their tenants, measured in scanned bytes, instead of first come first served.
+    """
+    if shard == SHARD_BY_SIZE:
+        batches = _batches_by_size(file_names, handle.processes)
+    else:
+        batches = _batches_by_path(file_names)
+
+    if tenant is not None:
+        yield from _scan_fair(handle, tenant, batches, scan_kwargs)
+        return
+
+    tasks = ((batch, scan_kwargs) for batch in batches)
+    for results in handle._pool.imap_unordered(_scan_batch, tasks):
+        yield from results
+
+
+def _scan_fair(handle: ProcessScanner, tenant, batches: Iterator[List[str]],
+               scan_kwargs: dict) -> Iterator[Tuple[str, str, str]]:
+    scheduler = handle._fair_scheduler()
+    results = queue.Queue()
+    outstanding = 0
+    for batch in batches:
+        scheduler.submit(tenant, ((batch, scan_kwargs), results), _batch_bytes(batch))
+        outstanding += 1
+        # hand back what is done while the walk goes on
+        while not results.empty():
+            outstanding -= 1
+            yield from results.get()
+    for _ in range(outstanding):
+        yield from results.get()
+
+
+def scan_tree(handle: ProcessScanner, root: str, shard: str = SHARD_BY_PATH, tenant=None,
+              **scan_kwargs) -> Iterator[Tuple[str, str, str]]:
+    def walk():
+        for directory, _, files in os.walk(root):
+            for file_name in files:
+                yield os.path.join(directory, file_name)
+
+    logger.debug(f"scanning {root} on {handle.processes} processes, sharded by {shard}")
+    return scan_files(handle, walk(), shard, tenant, **scan_kwargs)
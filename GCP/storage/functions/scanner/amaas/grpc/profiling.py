@@ -0,0 +1,127 @@
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import random
+import re
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# profile a sample of the scans, e.g. TM_AM_PROFILE=1 TM_AM_PROFILE_RATE=0.01 profiles one scan in a hundred
+# and writes its stats to TM_AM_PROFILE_DIR, to be read with pstats or snakeviz
+profile_enabled = os.environ.get('TM_AM_PROFILE', '').lower() in ('1', 'true', 'yes', 'on')
+profile_rate = float(os.environ.get('TM_AM_PROFILE_RATE', 1.0))
+profile_dir = os.environ.get('TM_AM_PROFILE_DIR', tempfile.gettempdir())
+
+# only one profiler can be active at a time, scans sampled while another one is profiled are skipped
+_profile_lock = threading.Lock()
+
+# how long a finished scan waits for the threads attached to its profile to wrap up
+ATTACH_WAIT_SECONDS = 1.0
+_current = threading.local()
+
+
+def set_profiling(enabled: bool, rate: float = None, directory: str = None) -> None:
+    global profile_enabled, profile_rate, profile_dir
+    profile_enabled = enabled
+    if rate is not None:
+        profile_rate = rate
+    if directory is not None:
+        profile_dir = directory
+
+
+class _ScanProfile:
+    """
+    Profiles the scan it wraps when it is sampled, both as a with and an async with block.
+    Other threads working for the scan join in with attach().
+    """
+
+    def __init__(self, identifier: str):
+        self._identifier = identifier
+        self._profiler = None
+        self._attached = []
+        self._running = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        if not profile_enabled or random.random() >= profile_rate:
+            return self
+        if not _profile_lock.acquire(blocking=False):
+            return self
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # some other profiler is already running in this process
+            _profile_lock.release()
+            return self
+        self._profiler = profiler
+        _current.profile = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._profiler is None:
+            return
+        self._profiler.disable()
+        _current.profile = None
+        with self._cond:
+            # threads still running after that are left out
+            self._cond.wait_for(lambda: self._running == 0, ATTACH_WAIT_SECONDS)
+            attached = self._attached[:]
+        try:
+            stats = pstats.Stats(self._profiler)
+            for profiler in attached:
+                stats.add(profiler)
+            name = re.sub(r'[^A-Za-z0-9._-]', '_', self._identifier)[:64]
+            path = os.path.join(profile_dir, f"amaas-{int(time.time() * 1000)}-{os.getpid()}-{name}.prof")
+            stats.dump_stats(path)
+            logger.debug(f"scan profile written to {path}")
+        except OSError as err:
+            logger.debug("failed to write scan profile: " + str(err))
+        finally:
+            self._profiler = None
+            _profile_lock.release()
+
+    @contextlib.contextmanager
+    def attach(self):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # profilers that cover every thread are already catching this one
+            yield
+            return
+        with self._cond:
+            self._running += 1
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self._cond:
+                self._attached.append(profiler)
+                self._running -= 1
+                self._cond.notify_all()
+
+    def attach_iterator(self, iterator):
+        """
+        Profile whichever thread consumes the iterator, e.g. the gRPC thread sending the request stream.
+        """
+        with self.attach():
+            yield from iterator
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.__exit__(exc_type, exc_value, traceback)
+
+
+def _active_profile():
+    """
+    Profile of the sync scan running on this thread, None when it is not sampled.
+    """
+    return getattr(_current, "profile", None)
@@ -1,11 +1,47 @@
+import asyncio
+import bisect
 import grpc
 import hashlib
+import io
+import os
+import threading
+import time
+import zlib
 from typing import BinaryIO, List
 from .exception import AMaasException
 from .exception import AMaasErrorCode
+from .protos import scan_pb2
 
 HASH_CHUNK_SIZE = 512 * 1024
 
+# RUN messages are encoded straight from pooled read buffers, room is left in front of the
+# data for the largest possible message header: stage, offset and chunk length
+RUN_HEADER_RESERVE = 16
+# pooled buffers come in these sizes, a request is rounded up to the next one, larger ones are not pooled,
+# a power of two range read plus its header fits a class exactly
+POOL_SIZE_CLASSES = tuple((64 * 1024 << i) + RUN_HEADER_RESERVE for i in range(8))
+POOL_MAX_BUFFERS_PER_SIZE = 16
+POOL_MAX_BYTES = 32 * 1024 * 1024
+
+# digest=DIGEST_DEFERRED sends INIT without digests and hashes the data while it is uploaded,
+# the digests are then only reported in the scan stats
+DIGEST_DEFERRED = "deferred"
+
+# scans are refused up front when less time than this is left before the caller's deadline
+MIN_SCAN_TIMEOUT = 1.0
+
+# adaptive compression: compress a few samples of the data and only enable
+# compression on the call when the expected saving is worth the CPU
+COMPRESSION_MIN_SIZE = 4 * 1024
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_SAMPLE_COUNT = 3
+COMPRESSION_MIN_SAVING = 0.1
+
+CompressionAlgorithms = {
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
+
 APP_NAME_HEADER = "tm-app-name"
 APP_NAME_FILE_SCAN = "V1FS"
 
@@ -48,6 +84,191 @@ V1ToC1RegionMapping = {AWS_AU_REGION: C1_AU_REGION,
                        }
 
 
+class ScanTimeoutPolicy:
+    """
+    Scan timeout derived from the size of the data: base seconds plus an allowance per MB,
+    optionally capped at maximum seconds. Pass it as the timeout of scan_file/scan_buffer.
+    """
+
+    def __init__(self, base: float = 10.0, per_mb: float = 1.0, maximum: float = None):
+        self.base = base
+        self.per_mb = per_mb
+        self.maximum = maximum
+
+    def __call__(self, size: int) -> float:
+        timeout = self.base + self.per_mb * size / (1024 * 1024)
+        if self.maximum is not None:
+            timeout = min(timeout, self.maximum)
+        return timeout
+
+
+def deadline_from_context(context, reserve: float = 1.0) -> float:
+    """
+    Deadline of a Lambda invocation as a time.time() timestamp, keeping reserve seconds for the caller.
+    """
+    return time.time() + context.get_remaining_time_in_millis() / 1000.0 - reserve
+
+
+class _ByteBudget:
+    """
+    Process wide ceiling on the bytes held by in-flight scan buffers and range reads.
+    Sync callers block and aio callers wait until enough bytes are released. A request
+    larger than the ceiling is clamped to it, so it waits for the whole budget to be free.
+    A limit of 0 disables the governor.
+    """
+
+    def __init__(self, limit: int = 0):
+        self._limit = limit
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    def set_limit(self, limit: int) -> None:
+        with self._cond:
+            self._limit = limit
+        self._wake()
+
+    def _try_reserve(self, size: int) -> bool:
+        if self._in_use + size <= self._limit:
+            self._in_use += size
+            return True
+        return False
+
+    def acquire(self, size: int) -> int:
+        if not self._limit or not size:
+            return 0
+        size = min(size, self._limit)
+        with self._cond:
+            while not self._try_reserve(size):
+                self._cond.wait()
+        return size
+
+    async def acquire_async(self, size: int) -> int:
+        if not self._limit or not size:
+            return 0
+        size = min(size, self._limit)
+        while True:
+            with self._cond:
+                if self._try_reserve(size):
+                    return size
+                loop = asyncio.get_running_loop()
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            finally:
+                # a cancelled waiter must not be woken on a loop that may be closed by then
+                with self._cond:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+
+    def release(self, size: int) -> None:
+        if not size:
+            return
+        with self._cond:
+            self._in_use -= size
+        self._wake()
+
+    def _wake(self):
+        with self._cond:
+            self._cond.notify_all()
+            waiters = self._async_waiters
+            self._async_waiters = []
+        for loop, waiter in waiters:
+            if loop.is_closed():
+                continue
+            try:
+                loop.call_soon_threadsafe(_set_waiter_done, waiter)
+            except RuntimeError:
+                # the loop closed since the check
+                pass
+
+
+def _set_waiter_done(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_byte_budget = _ByteBudget(int(os.environ.get('TM_AM_MAX_INFLIGHT_BYTES', 0)))
+
+
+def set_inflight_byte_limit(limit: int) -> None:
+    """
+    Set the ceiling on bytes held by in-flight scans, 0 means unlimited.
+    """
+    _byte_budget.set_limit(limit)
+
+
+def inflight_bytes() -> int:
+    return _byte_budget.in_use
+
+
+class _BufferPool:
+    """
+    Reusable bytearrays for range reads. Requests are rounded up to a fixed size class, so
+    the last chunk of every file reuses the same buffers, and at most max_bytes are kept.
+    A buffer handed out may be longer than asked for.
+    """
+
+    def __init__(self, size_classes=POOL_SIZE_CLASSES, max_buffers_per_size=POOL_MAX_BUFFERS_PER_SIZE,
+                 max_bytes=POOL_MAX_BYTES):
+        self._size_classes = size_classes
+        self._max_buffers_per_size = max_buffers_per_size
+        self._max_bytes = max_bytes
+        self._buffers = {size: [] for size in size_classes}
+        self._pooled_bytes = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, size: int) -> bytearray:
+        index = bisect.bisect_left(self._size_classes, size)
+        if index == len(self._size_classes):
+            return bytearray(size)
+        size = self._size_classes[index]
+        with self._lock:
+            free = self._buffers[size]
+            if free:
+                self._pooled_bytes -= size
+                return free.pop()
+        return bytearray(size)
+
+    def release(self, buffer: bytearray) -> None:
+        size = len(buffer)
+        free = self._buffers.get(size)
+        if free is None:
+            return
+        with self._lock:
+            if len(free) < self._max_buffers_per_size and self._pooled_bytes + size <= self._max_bytes:
+                free.append(buffer)
+                self._pooled_bytes += size
+
+
+_chunk_pool = _BufferPool()
+
+
+def _serialize_c2s(message) -> bytes:
+    if isinstance(message, bytes):
+        return message
+    return message.SerializeToString()
+
+
+class _ScanStub:
+    """
+    Same as scan_pb2_grpc.ScanStub, except that RUN messages already encoded by
+    _encode_run_chunk are sent as they are.
+    """
+
+    def __init__(self, channel):
+        self.Run = channel.stream_stream(
+            '/amaas.scan.v1.Scan/Run',
+            request_serializer=_serialize_c2s,
+            response_deserializer=scan_pb2.S2C.FromString,
+        )
+
+
 class _GrpcAuth(grpc.AuthMetadataPlugin):
     def __init__(self, key):
         self._key = key
@@ -56,7 +277,7 @@ class _GrpcAuth(grpc.AuthMetadataPlugin):
         callback((('authorization', self._key),), None)
 
 
-def _init_util(host, api_key=None, enable_tls=False, ca_cert=None, is_aio_channel=False):
+def _init_util(host, api_key=None, enable_tls=False, ca_cert=None, is_aio_channel=False, options=None):
     call_creds = None
     if api_key:
         auth_key_str = 'ApiKey ' + api_key
@@ -77,14 +298,24 @@ def _init_util(host, api_key=None, enable_tls=False, ca_cert=None, is_aio_channe
         else:
             creds = grpc.composite_channel_credentials(ssl_creds, call_creds)
 
-        channel = grpc.aio.secure_channel(host, creds) if is_aio_channel else grpc.secure_channel(host, creds)
+        if is_aio_channel:
+            channel = grpc.aio.secure_channel(host, creds, options)
+        else:
+            channel = grpc.secure_channel(host, creds, options)
     else:
-        channel = grpc.aio.insecure_channel(host) if is_aio_channel else grpc.insecure_channel(host)
+        channel = grpc.aio.insecure_channel(host, options) if is_aio_channel else grpc.insecure_channel(host, options)
 
     return channel
 
 
-def _init_by_region_util(region, api_key, enable_tls=True, ca_cert=None, is_aio_channel=False):
+def _warmup_util(channel, timeout):
+    try:
+        grpc.channel_ready_future(channel).result(timeout=timeout)
+    except grpc.FutureTimeoutError:
+        raise AMaasException(AMaasErrorCode.MSG_ID_ERR_CHANNEL_NOT_READY, timeout)
+
+
+def _region_host(region):
     mapping = {
         C1_US_REGION: 'antimalware.us-1.cloudone.trendmicro.com:443',
         C1_IN_REGION: 'antimalware.in-1.cloudone.trendmicro.com:443',
@@ -109,7 +340,11 @@ def _init_by_region_util(region, api_key, enable_tls=True, ca_cert=None, is_aio_
     host = mapping.get(region, None)
     if host is None:
         raise AMaasException(AMaasErrorCode.MSG_ID_ERR_INVALID_REGION, region)
-    return _init_util(host, api_key, enable_tls, ca_cert, is_aio_channel)
+    return host
+
+
+def _init_by_region_util(region, api_key, enable_tls=True, ca_cert=None, is_aio_channel=False):
+    return _init_util(_region_host(region), api_key, enable_tls, ca_cert, is_aio_channel)
 
 
 def _validate_tags(tags: List[str]):
@@ -122,21 +357,129 @@ def _validate_tags(tags: List[str]):
                 raise AMaasException(AMaasErrorCode.MSG_ID_ERR_INVALID_TAG, t)
 
 
-def _digest_hex(data_reader: BinaryIO, algorithm: str):
-    if algorithm == "sha1":
-        file_hash = hashlib.sha1()
-    elif algorithm == "sha256":
-        file_hash = hashlib.sha256()
-    else:
-        raise AMaasException(AMaasErrorCode.MSG_ID_ERR_UNEXPECTED_ERROR, "unsupported hash algorithm " + algorithm)
+def _resolve_timeout(size: int, timeout, deadline: float, default: float) -> float:
+    if timeout is None:
+        timeout = default
+    elif callable(timeout):
+        timeout = timeout(size)
+
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.time())
+        # fail fast instead of starting a scan that cannot finish in time
+        if timeout < MIN_SCAN_TIMEOUT:
+            raise AMaasException(AMaasErrorCode.MSG_ID_ERR_DEADLINE_TOO_SHORT, max(timeout, 0.0))
+    return timeout
+
+
+def _select_compression(data_reader: BinaryIO, size: int, algorithm: str, stats: dict):
+    if not algorithm:
+        return None
+    if algorithm not in CompressionAlgorithms:
+        raise AMaasException(AMaasErrorCode.MSG_ID_ERR_INVALID_COMPRESSION, algorithm, list(CompressionAlgorithms))
+    if size < COMPRESSION_MIN_SIZE:
+        stats["compression"] = "none"
+        return None
+
+    start = time.process_time()
+    w = data_reader.tell()
+    step = max(size - COMPRESSION_SAMPLE_SIZE, 0) // max(COMPRESSION_SAMPLE_COUNT - 1, 1)
+    sampled = 0
+    compressed = 0
+    for offset in sorted({i * step for i in range(COMPRESSION_SAMPLE_COUNT)}):
+        data_reader.seek(offset)
+        sample = data_reader.read(COMPRESSION_SAMPLE_SIZE)
+        sampled += len(sample)
+        compressed += len(zlib.compress(sample, 6))
+    data_reader.seek(w)
+    sample_cpu = time.process_time() - start
+
+    ratio = compressed / sampled if sampled else 1.0
+    stats["compression_ratio"] = round(ratio, 3)
+    if 1.0 - ratio < COMPRESSION_MIN_SAVING:
+        stats["compression"] = "none"
+        stats["compression_cpu_seconds"] = sample_cpu
+        return None
+
+    # the compression itself runs inside gRPC core, so extrapolate its cost from the samples
+    stats["compression"] = algorithm
+    stats["compression_saved_bytes"] = int(size * (1.0 - ratio))
+    stats["compression_cpu_seconds"] = sample_cpu + sample_cpu * size / sampled
+    return CompressionAlgorithms[algorithm]
+
+
+def _file_digests(data_reader: BinaryIO, stop: threading.Event = None):
+    """
+    sha1 and sha256 digests of the whole reader in a single pass, None when stop is set before the end.
+    """
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
 
     w = data_reader.tell()
     data_reader.seek(0)
 
     chunk = data_reader.read(HASH_CHUNK_SIZE)
     while chunk:
-        file_hash.update(chunk)
+        if stop is not None and stop.is_set():
+            data_reader.seek(w)
+            return None
+        sha1.update(chunk)
+        sha256.update(chunk)
         chunk = data_reader.read(HASH_CHUNK_SIZE)
 
     data_reader.seek(w)
-    return file_hash.hexdigest()
+    return "sha1:" + sha1.hexdigest(), "sha256:" + sha256.hexdigest()
+
+
+def _detached_digests(data_reader: BinaryIO, stats: dict, stop: threading.Event = None) -> None:
+    # hash through a separate handle so the reader can serve range reads at the same time,
+    # getvalue() of an untouched BytesIO hands back the original bytes without a copy
+    if isinstance(data_reader, io.BytesIO):
+        reader = io.BytesIO(data_reader.getvalue())
+    else:
+        reader = open(data_reader.name, "rb")
+    with reader:
+        digests = _file_digests(reader, stop)
+    if digests is not None:
+        stats["file_sha1"], stats["file_sha256"] = digests
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+_RUN_STAGE_FIELD = bytes([1 << 3, scan_pb2.STAGE_RUN])
+_OFFSET_TAG = bytes([4 << 3])
+_CHUNK_TAG = bytes([(5 << 3) | 2])
+
+
+def _encode_run_chunk(data_reader: BinaryIO, offset: int, length: int):
+    """
+    Read a range with readinto into a pooled buffer and encode it as a serialized C2S RUN message.
+    Returns the message and the number of bytes read. The only copy of the data besides the read
+    is the final bytes object gRPC needs, the protobuf message and its serialization are skipped.
+    """
+    buffer = _chunk_pool.acquire(RUN_HEADER_RESERVE + length)
+    try:
+        with memoryview(buffer) as view:
+            data_reader.seek(offset)
+            n = 0
+            while n < length:
+                r = data_reader.readinto(view[RUN_HEADER_RESERVE + n:RUN_HEADER_RESERVE + length])
+                if not r:
+                    break
+                n += r
+
+            header = _RUN_STAGE_FIELD
+            if offset:
+                header += _OFFSET_TAG + _varint(offset)
+            header += _CHUNK_TAG + _varint(n)
+            start = RUN_HEADER_RESERVE - len(header)
+            view[start:RUN_HEADER_RESERVE] = header
+            return bytes(view[start:RUN_HEADER_RESERVE + n]), n
+    finally:
+        _chunk_pool.release(buffer)